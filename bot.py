@@ -2,12 +2,26 @@
 # (텍스트 수량 입력 / 뒤로가기만, 주문 영구 저장 + 미지정 입금 알림 + 디버깅 강화 + 허용오차 환경변수)
 
 import os
+import sys
+import abc
 import asyncio
+import bisect
+import codecs
+import functools
+import hashlib
+import hmac
+import html
 import logging
 import json
 import re
 import random
+import secrets
+import sqlite3
+import threading
+import time
+from collections import Counter, deque
 from pathlib import Path
+from urllib.parse import urlsplit
 from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -15,10 +29,12 @@ from telegram.ext import (
     ApplicationBuilder, CommandHandler, CallbackQueryHandler,
     MessageHandler, ContextTypes, filters,
 )
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
 from telegram.helpers import escape_markdown
 
 import aiohttp
+from aiohttp import web
 
 # ─────────────────────────────────────────────
 # 안전한 MarkdownV2 이스케이프 함수
@@ -75,6 +91,9 @@ except InvalidOperation:
 # 허용오차(매칭) 기본값 0.10 USDT
 AMOUNT_TOLERANCE = _dec(os.getenv("AMOUNT_TOLERANCE", "0.10"))
 
+# 결제 제한시간(초) = 15분
+ORDER_TTL = 900
+
 LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG").upper()
 
 # ─────────────────────────────────────────────
@@ -97,7 +116,7 @@ if not ADMIN_CHAT_ID:
     log.warning("⚠️ ADMIN_CHAT_ID가 설정되지 않아 운영자 알림이 전송되지 않습니다. .env에 본인 chat_id를 넣어주세요.")
 
 
-log.info("🔑 TRON_API_KEY=%s", os.getenv("TRON_API_KEY"))
+log.info("🔑 TRON_API_KEYS=%s", [k[:8] + "..." for k in (os.getenv("TRON_API_KEYS") or os.getenv("TRON_API_KEY") or "").split(",") if k.strip()])
 
 # ─────────────────────────────────────────────
 # 안내 텍스트
@@ -128,39 +147,186 @@ NOTICE_TEXT = (
     "➖➖➖➖➖➖➖➖➖➖➖➖➖"
 )
 
+# ─────────────────────────────────────────────
+# 이벤트 루프 지연 모니터 / 샘플링 프로파일러
+# ─────────────────────────────────────────────
+LAG_INTERVAL = float(os.getenv("LAG_INTERVAL", "0.5") or "0.5")     # 지연 측정 주기(초)
+LAG_WARN = float(os.getenv("LAG_WARN", "0.2") or "0.2")             # 이 이상 루프를 막으면 경고 로그(초)
+PROFILE_MAX_SECONDS = 60
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_DIR = BASE_DIR / "profiles"
+
+class LoopLagMonitor:
+    """루프 지연(예정 시각 대비 깨어난 시각) 샘플과 함수별 루프 점유 시간 기록"""
+    def __init__(self, keep: int = 7200):
+        self.samples: deque = deque(maxlen=keep)     # (time, lag)
+        self.blocks: dict[str, list] = {}            # name -> [호출 수, 합계, 최대]
+
+    async def run(self):
+        while True:
+            t = time.perf_counter()
+            await asyncio.sleep(LAG_INTERVAL)
+            lag = time.perf_counter() - t - LAG_INTERVAL
+            self.samples.append((time.time(), lag))
+            if lag > LAG_WARN:
+                log.warning("[LOOP_LAG] %.3fs", lag)
+
+    def record(self, name: str, seconds: float):
+        s = self.blocks.get(name)
+        if s is None:
+            s = self.blocks[name] = [0, 0.0, 0.0]
+        s[0] += 1
+        s[1] += seconds
+        if seconds > s[2]:
+            s[2] = seconds
+        if seconds > LAG_WARN:
+            log.warning("[LOOP_BLOCK] %s %.3fs", name, seconds)
+
+    def report(self, window: float = 300) -> str:
+        now = time.time()
+        lags = sorted(lag for t, lag in self.samples if now - t <= window)
+        lines = [f"⏱ 루프 지연 (최근 {int(window)}초, 샘플 {len(lags)}개)"]
+        if lags:
+            p = lambda q: lags[min(len(lags) - 1, int(len(lags) * q))]
+            lines.append(f"- p50 {p(0.5) * 1000:.1f}ms / p99 {p(0.99) * 1000:.1f}ms / max {lags[-1] * 1000:.1f}ms")
+        lines.append("⏱ 루프 점유 (최대 기준 상위)")
+        top = sorted(self.blocks.items(), key=lambda kv: kv[1][2], reverse=True)[:10]
+        for name, (n, total, worst) in top:
+            lines.append(f"- {name}: {n}회 평균 {total / n * 1000:.1f}ms 최대 {worst * 1000:.1f}ms")
+        return "\n".join(lines)
+
+lag_monitor = LoopLagMonitor()
+
+class _BlockTimer:
+    """코루틴을 한 단계씩 실행하며 각 단계(= 루프를 막는 구간)의 시간을 잼"""
+    __slots__ = ("coro", "name")
+
+    def __init__(self, coro, name):
+        self.coro = coro
+        self.name = name
+
+    def __await__(self):
+        send, exc, worst = None, None, 0.0
+        while True:
+            t = time.perf_counter()
+            try:
+                step = self.coro.throw(exc) if exc is not None else self.coro.send(send)
+            except StopIteration as e:
+                lag_monitor.record(self.name, max(worst, time.perf_counter() - t))
+                return e.value
+            except BaseException:
+                lag_monitor.record(self.name, max(worst, time.perf_counter() - t))
+                raise
+            worst = max(worst, time.perf_counter() - t)
+            try:
+                send, exc = (yield step), None
+            except BaseException as e:
+                send, exc = None, e
+
+def _track_block(fn):
+    """동기 함수는 실행 시간, 코루틴 함수는 한 번에 루프를 점유한 최대 시간을 lag_monitor에 기록"""
+    name = fn.__name__
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            return await _BlockTimer(fn(*args, **kwargs), name)
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        t = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            lag_monitor.record(name, time.perf_counter() - t)
+    return wrapper
+
+class SamplingProfiler:
+    """지정 스레드(이벤트 루프)의 스택을 주기적으로 샘플링. 켜져 있을 때만 별도 스레드가 동작"""
+    def __init__(self):
+        self.running = False
+
+    def run(self, thread_id: int, seconds: float) -> Counter:
+        stacks: Counter = Counter()
+        self.running = True
+        try:
+            end = time.monotonic() + seconds
+            while time.monotonic() < end:
+                frame = sys._current_frames().get(thread_id)
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{Path(code.co_filename).name}:{code.co_name}:{code.co_firstlineno}")
+                    frame = frame.f_back
+                if names:
+                    stacks[";".join(reversed(names))] += 1
+                time.sleep(PROFILE_SAMPLE_INTERVAL)
+        finally:
+            self.running = False
+        return stacks
+
+    @staticmethod
+    def report(stacks: Counter, top: int = 15) -> str:
+        total = sum(stacks.values()) or 1
+        own, incl = Counter(), Counter()
+        for stack, n in stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += n
+            for f in set(frames):
+                incl[f] += n
+        lines = [f"🔬 상위 함수 (샘플 {total}개, self% / total%)"]
+        for f, n in own.most_common(top):
+            lines.append(f"- {n / total * 100:5.1f}% / {incl[f] / total * 100:5.1f}%  {f}")
+        return "\n".join(lines)
+
+    @staticmethod
+    def dump(stacks: Counter, path: Path):
+        """flamegraph.pl / speedscope 에서 읽는 collapsed stack 형식"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("".join(f"{s} {n}\n" for s, n in stacks.items()), encoding="utf-8")
+
+profiler = SamplingProfiler()
+
 # ─────────────────────────────────────────────
 # 상태 저장 (주문/처리TX)
 # ─────────────────────────────────────────────
 pending_orders: dict[str, dict] = {}
 processed_txs: set[str] = set()
-last_seen_ts: float = 0.0   # ★ 추가
 
+@_track_block
 def _save_state():
     try:
         data = {
             "pending_orders": {
                 str(uid): {
-                    "qty": v["qty"],
+                    **v,
                     "amount": str(v["amount"]),
-                    "chat_id": v["chat_id"],
-                    "created_at": v.get("created_at", datetime.utcnow().timestamp())
+                    "created_at": v.get("created_at", time.time())
                 }
                 for uid, v in pending_orders.items()
             },
             "processed_txs": list(processed_txs)[-2000:],
-            "last_seen_ts": last_seen_ts,
+            "stream_cursors": {st.key: st.last_seen_ts for st in PAYMENT_STREAMS},
+            "node_cursor": node_scanner.dump(),
             "seen_txids": list(seen_txids)[-2000:],  # 최근 본 TXID 저장
+            "sender_ledger": sender_ledger.dump(),
+            "sender_credits": {addr: str(v) for addr, v in sender_credits.items()},
+            "outbox_seq": payment_outbox.applied,   # 여기까지의 결제 이벤트가 반영된 상태
         }
-        STATE_FILE.write_text(
+        # 임시 파일에 쓴 뒤 교체 → 중간에 죽어도 이전 상태 또는 새 상태 중 하나만 남음
+        tmp = STATE_FILE.with_suffix(".tmp")
+        tmp.write_text(
             json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8"
         )
-        log.debug("[STATE] saved pending=%s processed=%s last_seen=%s",
-                  len(pending_orders), len(processed_txs), last_seen_ts)
+        os.replace(tmp, STATE_FILE)
+        payment_outbox.checkpoint = data["outbox_seq"]
+        log.debug("[STATE] saved pending=%s processed=%s",
+                  len(pending_orders), len(processed_txs))
     except Exception as e:
         log.error("[STATE_SAVE_ERROR] %s", e)
 
 def _load_state():
-    global pending_orders, processed_txs, last_seen_ts, seen_txids
+    global pending_orders, processed_txs, seen_txids
     if not STATE_FILE.exists():
         return
     try:
@@ -169,21 +335,161 @@ def _load_state():
         for uid, v in (data.get("pending_orders") or {}).items():
             try:
                 po[str(uid)] = {
+                    **v,
                     "qty": int(v["qty"]),
-                    "amount": _dec(v["amount"]),
+                    "amount": _dec(v["amount"], "0.001"),
                     "chat_id": int(v["chat_id"]),
-                    "created_at": float(v.get("created_at", datetime.utcnow().timestamp())),
+                    "created_at": float(v.get("created_at", time.time())),
                 }
             except Exception:
                 continue
         pending_orders = po
         processed_txs = set(data.get("processed_txs") or [])
-        last_seen_ts = float(data.get("last_seen_ts", 0))
+        cursors = data.get("stream_cursors") or {}
+        if not cursors and data.get("last_seen_ts"):
+            # 예전 형식: 기본 주소/USDT 단일 커서
+            cursors = {PAYMENT_STREAMS[0].key: data["last_seen_ts"]}
+        for st in PAYMENT_STREAMS:
+            st.last_seen_ts = float(cursors.get(st.key, 0))
+        node_scanner.restore(data.get("node_cursor") or {})
         seen_txids = set(data.get("seen_txids") or [])
+        sender_ledger.restore(data.get("sender_ledger") or [])
+        sender_credits.clear()
+        sender_credits.update({addr: _dec(v, "0.000001") for addr, v in (data.get("sender_credits") or {}).items()})
+        payment_outbox.applied = payment_outbox.checkpoint = int(data.get("outbox_seq") or 0)
         log.info("[STATE] loaded pending=%s processed=%s", len(pending_orders), len(processed_txs))
     except Exception as e:
         log.error("[STATE_LOAD_ERROR] %s", e)
 
+# ─────────────────────────────────────────────
+# 대화 세션 (유저별 주문 진행 상태)
+# ─────────────────────────────────────────────
+SESSION_TTL = int(os.getenv("SESSION_TTL", "900") or "900")              # 유휴 세션 만료(초)
+SESSION_MAX_LINKS = int(os.getenv("SESSION_MAX_LINKS", "20") or "20")    # 게시글 링크 최대 개수
+SESSION_BACKEND = (os.getenv("SESSION_BACKEND") or "file").strip().lower()  # file | memory
+SESSION_FILE = BASE_DIR / "sessions.json"
+
+class Session:
+    """주문 진행 중인 유저 1명의 상태. kind=ghost/telf/views/reacts, state=qty/post_count/links/target"""
+    __slots__ = ("kind", "state", "qty", "amount", "post_count", "links", "touched")
+
+    def __init__(self, kind, state="qty", qty=0, amount=None, post_count=0, links=None, touched=None):
+        self.kind = kind
+        self.state = state
+        self.qty = qty
+        self.amount = amount
+        self.post_count = post_count
+        self.links = links
+        self.touched = touched or time.time()
+
+    def to_dict(self):
+        return {
+            "kind": self.kind,
+            "state": self.state,
+            "qty": self.qty,
+            "amount": str(self.amount) if self.amount is not None else None,
+            "post_count": self.post_count,
+            "links": self.links,
+            "touched": self.touched,
+        }
+
+    @classmethod
+    def from_dict(cls, v):
+        return cls(
+            kind=v["kind"],
+            state=v["state"],
+            qty=int(v.get("qty") or 0),
+            amount=_dec(v["amount"], "0.001") if v.get("amount") is not None else None,
+            post_count=int(v.get("post_count") or 0),
+            links=list(v["links"])[:SESSION_MAX_LINKS] if v.get("links") is not None else None,
+            touched=float(v.get("touched") or 0),
+        )
+
+class MemorySessionBackend:
+    """세션을 저장하지 않는 백엔드 (재시작 시 진행 중 대화 초기화)"""
+    def load(self) -> dict:
+        return {}
+
+    def save(self, data: dict):
+        pass
+
+class FileSessionBackend(MemorySessionBackend):
+    """세션을 JSON 파일 하나에 저장하는 백엔드"""
+    def __init__(self, path: Path):
+        self.path = path
+
+    def load(self) -> dict:
+        if not self.path.exists():
+            return {}
+        return json.loads(self.path.read_text(encoding="utf-8"))
+
+    def save(self, data: dict):
+        # 임시 파일에 쓴 뒤 교체 → 저장 중 죽어도 이전 파일이 그대로 남음
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+SESSION_BACKENDS = {
+    "memory": MemorySessionBackend,
+    "file": lambda: FileSessionBackend(SESSION_FILE),
+}
+
+session_backend = SESSION_BACKENDS.get(SESSION_BACKEND, SESSION_BACKENDS["file"])()
+sessions: dict[str, Session] = {}
+
+def _save_sessions():
+    try:
+        session_backend.save({uid: s.to_dict() for uid, s in sessions.items()})
+    except Exception as e:
+        log.error("[SESSION_SAVE_ERROR] %s", e)
+
+def _load_sessions():
+    global sessions
+    try:
+        now = time.time()
+        loaded = {}
+        for uid, v in (session_backend.load() or {}).items():
+            try:
+                s = Session.from_dict(v)
+            except Exception:
+                continue
+            if now - s.touched <= SESSION_TTL:
+                loaded[str(uid)] = s
+        sessions = loaded
+        log.info("[SESSION] loaded=%s backend=%s", len(sessions), SESSION_BACKEND)
+    except Exception as e:
+        log.error("[SESSION_LOAD_ERROR] %s", e)
+
+def _start_session(uid: str, kind: str) -> Session:
+    s = sessions[uid] = Session(kind)
+    _save_sessions()
+    return s
+
+def _get_session(uid: str):
+    """유휴 시간이 지나지 않은 세션만 반환 (조회 시 touched 갱신)"""
+    s = sessions.get(uid)
+    if s is None:
+        return None
+    now = time.time()
+    if now - s.touched > SESSION_TTL:
+        _end_session(uid)
+        return None
+    s.touched = now
+    return s
+
+def _end_session(uid: str):
+    if sessions.pop(uid, None) is not None:
+        _save_sessions()
+
+async def _gc_sessions(context: ContextTypes.DEFAULT_TYPE):
+    now = time.time()
+    idle = [uid for uid, s in sessions.items() if now - s.touched > SESSION_TTL]
+    for uid in idle:
+        sessions.pop(uid, None)
+    if idle:
+        _save_sessions()
+        log.debug("[SESSION_GC] removed=%s remain=%s", len(idle), len(sessions))
+
 # ─────────────────────────────────────────────
 # 키보드
 # ─────────────────────────────────────────────
@@ -206,19 +512,42 @@ def main_menu_kb():
 def back_only_kb():
     return InlineKeyboardMarkup([[InlineKeyboardButton("◀️ 메뉴로 돌아가기", callback_data="back:main")]])
 
+# ─────────────────────────────────────────────
+# 주문 수량 검증 / 금액 계산 (채팅 주문 · 대량 주문 API 공용)
+# ─────────────────────────────────────────────
+ORDER_PRICES = {
+    "ghost": PER_100_PRICE,
+    "telf": PER_100_PRICE_TELF,
+    "views": PER_100_PRICE_VIEWS,
+    "reacts": PER_100_PRICE_REACTS,
+}
+
+def _valid_qty(qty: int) -> bool:
+    return qty >= 100 and qty % 100 == 0
+
+def _base_amount(per_100: Decimal, qty: int) -> Decimal:
+    return (per_100 * Decimal(qty // 100)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+
+def _order_amount(per_100: Decimal, qty: int) -> Decimal:
+    """기본 금액 + 0.001 ~ 0.009 USDT 랜덤 오프셋 (입금 구분용)"""
+    unique_offset = Decimal(str(random.randint(1, 9))) / Decimal("1000")
+    return (_base_amount(per_100, qty) + unique_offset).quantize(Decimal("0.001"), rounding=ROUND_HALF_UP)
+
 # ─────────────────────────────────────────────
 # 핸들러들
 # ─────────────────────────────────────────────
+@_track_block
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(WELCOME_TEXT, reply_markup=main_menu_kb())
 
+@_track_block
 async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await q.answer()
 
     if q.data == "menu:ghost":
-        context.user_data["awaiting_qty"] = True
-        log.info("[MENU] user=%s → awaiting_qty=True", q.from_user.id)
+        _start_session(str(q.from_user.id), "ghost")
+        log.info("[MENU] user=%s → session ghost:qty", q.from_user.id)
         await q.edit_message_text(
             "유령인원 수량을 입력해주세요\n"
             "예: 100, 500, 1000  100단위만 가능합니다.\n"
@@ -228,8 +557,8 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if q.data == "menu:telf_ghost":
-        context.user_data["awaiting_qty_telf"] = True
-        log.info("[MENU] user=%s → awaiting_qty_telf=True", q.from_user.id)
+        _start_session(str(q.from_user.id), "telf")
+        log.info("[MENU] user=%s → session telf:qty", q.from_user.id)
         await q.edit_message_text(
             "텔프유령인원 수량을 입력해주세요\n"
             "예: 100, 500, 1000  100단위만 가능합니다.\n"
@@ -239,8 +568,8 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if q.data == "menu:views":
-        context.user_data["awaiting_qty_views"] = True
-        log.info("[MENU] user=%s → awaiting_qty_views=True", q.from_user.id)
+        _start_session(str(q.from_user.id), "views")
+        log.info("[MENU] user=%s → session views:qty", q.from_user.id)
         await q.edit_message_text(
             "조회수 수량을 입력해주세요\n"
             "예: 100, 500, 1000  (100단위만 가능)\n"
@@ -250,8 +579,8 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if q.data == "menu:reactions":
-        context.user_data["awaiting_qty_reacts"] = True
-        log.info("[MENU] user=%s → awaiting_qty_reacts=True", q.from_user.id)
+        _start_session(str(q.from_user.id), "reacts")
+        log.info("[MENU] user=%s → session reacts:qty", q.from_user.id)
         await q.edit_message_text(
             "게시글 반응 수량을 입력해주세요\n"
             "예: 100, 500, 1000  (100단위만 가능)\n"
@@ -265,58 +594,52 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if q.data == "back:main":
-        for key in [
-            "awaiting_qty", "awaiting_target",
-            "awaiting_qty_telf", "awaiting_target_telf",
-            "awaiting_qty_views", "awaiting_post_count_views", "awaiting_link_views",
-            "awaiting_qty_reacts", "awaiting_post_count_reacts", "awaiting_link_reacts"
-        ]:
-            context.user_data.pop(key, None)
+        _end_session(str(q.from_user.id))
         await q.edit_message_text(WELCOME_TEXT, reply_markup=main_menu_kb())
         return
 
     await q.answer("준비 중입니다.", show_alert=True)
 
 # --- 단일 입력 핸들러 ---
+@_track_block
 async def text_input_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    s = _get_session(user_id)
+    if s is None:
+        return
+
     # 1) 수량 입력 대기 상태일 때
-    if context.user_data.get("awaiting_qty"):
+    if s.kind == "ghost" and s.state == "qty":
         text = update.message.text.strip().replace(",", "")
         if not text.isdigit():
             await update.message.reply_text("❌ 수량은 숫자만 입력해주세요. 예) 600, 1000", reply_markup=back_only_kb())
             return
 
         qty = int(text)
-        if qty < 100 or qty % 100 != 0:
+        if not _valid_qty(qty):
             await update.message.reply_text("❌ 100단위로만 입력 가능합니다. 예) 600, 1000, 3000", reply_markup=back_only_kb())
             return
 
         # 금액 계산
-        blocks = qty // 100
-        base_amount = (PER_100_PRICE * Decimal(blocks)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-
-        # 0.001 ~ 0.009 USDT 랜덤 오프셋
-        unique_offset = Decimal(str(random.randint(1, 9))) / Decimal("1000")
-
-        # 최종 금액
-        amount = (base_amount + unique_offset).quantize(Decimal("0.001"), rounding=ROUND_HALF_UP)
+        amount = _order_amount(PER_100_PRICE, qty)
 
         # 상태 업데이트
-        context.user_data["awaiting_qty"] = False
-        context.user_data["awaiting_target"] = True
-        context.user_data["ghost_qty"] = qty
-        context.user_data["ghost_amount"] = amount
+        s.state = "target"
+        s.qty = qty
+        s.amount = amount
+        _save_sessions()
 
-        user_id = str(update.effective_user.id)
         chat_id = update.effective_chat.id
         pending_orders[user_id] = {
             "qty": qty,    
             "amount": amount,
             "chat_id": chat_id,
             "type": "ghost",        
-            "created_at": datetime.utcnow().timestamp()
+            "pay_address": _assign_pay_address(),
+            "created_at": time.time()
         }
         _save_state()
+        _stats_order("created", pending_orders[user_id])
         log.info("[STATE] 주문 저장됨 uid=%s qty=%s amount=%s", user_id, qty, amount)
 
         await update.message.reply_text(
@@ -327,39 +650,37 @@ async def text_input_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
     # --- 텔프유령인원 수량 입력 ---
-    if context.user_data.get("awaiting_qty_telf"):
+    if s.kind == "telf" and s.state == "qty":
         text = update.message.text.strip().replace(",", "")
         if not text.isdigit():
             await update.message.reply_text("❌ 수량은 숫자만 입력해주세요. 예) 600, 1000", reply_markup=back_only_kb())
             return
 
         qty = int(text)
-        if qty < 100 or qty % 100 != 0:
+        if not _valid_qty(qty):
             await update.message.reply_text("❌ 100단위로만 입력 가능합니다. 예) 600, 1000, 3000", reply_markup=back_only_kb())
             return
 
         # ✅ 금액 계산
-        blocks = qty // 100
-        base_amount = (PER_100_PRICE_TELF * Decimal(blocks)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-        unique_offset = Decimal(str(random.randint(1, 9))) / Decimal("1000")
-        amount = (base_amount + unique_offset).quantize(Decimal("0.001"), rounding=ROUND_HALF_UP)
+        amount = _order_amount(PER_100_PRICE_TELF, qty)
 
         # ✅ 여기서 미리 저장
-        context.user_data["awaiting_qty_telf"] = False
-        context.user_data["awaiting_target_telf"] = True
-        context.user_data["ghost_qty_telf"] = qty
-        context.user_data["ghost_amount_telf"] = amount
+        s.state = "target"
+        s.qty = qty
+        s.amount = amount
+        _save_sessions()
 
-        user_id = str(update.effective_user.id)
         chat_id = update.effective_chat.id
         pending_orders[user_id] = {
             "qty": qty,
             "amount": amount, 
             "chat_id": chat_id,
             "type": "telf",
-            "created_at": datetime.utcnow().timestamp()
+            "pay_address": _assign_pay_address(),
+            "created_at": time.time()
         }
         _save_state()
+        _stats_order("created", pending_orders[user_id])
 
         await update.message.reply_text(
             f"✅ 텔프유령인원 {qty:,}명 주문 확인되었습니다.\n"
@@ -369,27 +690,24 @@ async def text_input_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
     # --- 조회수 수량 입력 ---
-    if context.user_data.get("awaiting_qty_views"):
+    if s.kind == "views" and s.state == "qty":
         text = update.message.text.strip().replace(",", "")
         if not text.isdigit():
             await update.message.reply_text("❌ 수량은 숫자만 입력해주세요.", reply_markup=back_only_kb())
             return
         qty = int(text)
-        if qty < 100 or qty % 100 != 0:
+        if not _valid_qty(qty):
             await update.message.reply_text("❌ 100단위로만 입력 가능합니다. 예) 600, 1000", reply_markup=back_only_kb())
             return
 
         # ✅ 금액 계산
-        blocks = qty // 100
-        base_amount = (PER_100_PRICE_VIEWS * Decimal(blocks)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-        unique_offset = Decimal(str(random.randint(1, 9))) / Decimal("1000")
-        amount = (base_amount + unique_offset).quantize(Decimal("0.001"), rounding=ROUND_HALF_UP)
+        amount = _order_amount(PER_100_PRICE_VIEWS, qty)
 
         # ✅ 저장
-        context.user_data["views_qty"] = qty
-        context.user_data["views_amount"] = amount
-        context.user_data["awaiting_qty_views"] = False
-        context.user_data["awaiting_post_count_views"] = True
+        s.qty = qty
+        s.amount = amount
+        s.state = "post_count"
+        _save_sessions()
 
         await update.message.reply_text(
             f"✅ 조회수 {qty:,}개 주문 확인되었습니다.\n"
@@ -400,27 +718,24 @@ async def text_input_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
     # --- 반응 수량 입력 ---
-    if context.user_data.get("awaiting_qty_reacts"):
+    if s.kind == "reacts" and s.state == "qty":
         text = update.message.text.strip().replace(",", "")
         if not text.isdigit():
             await update.message.reply_text("❌ 수량은 숫자만 입력해주세요.", reply_markup=back_only_kb())
             return
         qty = int(text)
-        if qty < 100 or qty % 100 != 0:
+        if not _valid_qty(qty):
             await update.message.reply_text("❌ 100단위로만 입력 가능합니다. 예) 600, 1000", reply_markup=back_only_kb())
             return
 
         # ✅ 금액 계산
-        blocks = qty // 100
-        base_amount = (PER_100_PRICE_REACTS * Decimal(blocks)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-        unique_offset = Decimal(str(random.randint(1, 9))) / Decimal("1000")
-        amount = (base_amount + unique_offset).quantize(Decimal("0.001"), rounding=ROUND_HALF_UP)
+        amount = _order_amount(PER_100_PRICE_REACTS, qty)
 
         # ✅ 저장
-        context.user_data["reacts_qty"] = qty
-        context.user_data["reacts_amount"] = amount
-        context.user_data["awaiting_qty_reacts"] = False
-        context.user_data["awaiting_post_count_reacts"] = True
+        s.qty = qty
+        s.amount = amount
+        s.state = "post_count"
+        _save_sessions()
 
         await update.message.reply_text(
             f"✅ 반응 {qty:,}개 주문 확인되었습니다.\n"
@@ -431,17 +746,20 @@ async def text_input_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
     # --- 조회수 게시글 개수 입력 ---
-    if context.user_data.get("awaiting_post_count_views"):
+    if s.kind == "views" and s.state == "post_count":
         try:
             post_count = int(update.message.text.strip())
         except ValueError:
             await update.message.reply_text("❌ 숫자만 입력해주세요.")
             return
+        if not 1 <= post_count <= SESSION_MAX_LINKS:
+            await update.message.reply_text(f"❌ 게시글 수량은 1~{SESSION_MAX_LINKS}개까지 가능합니다.")
+            return
 
-        context.user_data["views_post_count"] = post_count
-        context.user_data["views_links"] = []              # ✅ 리스트 초기화
-        context.user_data["awaiting_post_count_views"] = False
-        context.user_data["awaiting_link_views"] = True    # ✅ 다음 단계 플래그 세팅
+        s.post_count = post_count
+        s.links = []              # ✅ 리스트 초기화
+        s.state = "links"         # ✅ 다음 단계 세팅
+        _save_sessions()
 
         await update.message.reply_text(
             f"📌 진행할 게시글 링크 {post_count}개를 순서대로 입력해주세요.",
@@ -450,17 +768,20 @@ async def text_input_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
     # --- 반응 게시글 개수 입력 ---
-    if context.user_data.get("awaiting_post_count_reacts"):
+    if s.kind == "reacts" and s.state == "post_count":
         try:
             post_count = int(update.message.text.strip())
         except ValueError:
             await update.message.reply_text("❌ 숫자만 입력해주세요.")
             return
+        if not 1 <= post_count <= SESSION_MAX_LINKS:
+            await update.message.reply_text(f"❌ 게시글 수량은 1~{SESSION_MAX_LINKS}개까지 가능합니다.")
+            return
 
-        context.user_data["reacts_post_count"] = post_count
-        context.user_data["reacts_links"] = []              # ✅ 리스트 초기화
-        context.user_data["awaiting_post_count_reacts"] = False
-        context.user_data["awaiting_link_reacts"] = True    # ✅ 다음 단계 플래그 세팅
+        s.post_count = post_count
+        s.links = []              # ✅ 리스트 초기화
+        s.state = "links"         # ✅ 다음 단계 세팅
+        _save_sessions()
 
         await update.message.reply_text(
             f"📌 진행할 게시글 링크 {post_count}개를 순서대로 입력해주세요.",
@@ -469,25 +790,24 @@ async def text_input_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
     # --- 유령인원 주소 입력 ---
-    if context.user_data.get("awaiting_target"):
+    if s.kind == "ghost" and s.state == "target":
         target = update.message.text.strip()
-        context.user_data["awaiting_target"] = False
-        context.user_data["ghost_target"] = target
 
-        user_id = str(update.effective_user.id)
         if user_id in pending_orders:
             pending_orders[user_id]["target"] = target
             _save_state()
+        pay_address = pending_orders.get(user_id, {}).get("pay_address", PAYMENT_ADDRESS)
 
-        qty = context.user_data["ghost_qty"]
-        amount = context.user_data["ghost_amount"]
+        qty = s.qty
+        amount = s.amount
+        _end_session(user_id)
 
         await update.message.reply_text(
             "🧾 최종 주문 요약\n"
             f"- 유령인원: {qty:,}명\n"
             f"- 대상주소: {target}\n"
             f"- 결제수단: USDT(TRC20)\n"
-            f"- 결제주소: {PAYMENT_ADDRESS}\n"
+            f"- 결제주소: {pay_address}\n"
             f"- 결제금액: {amount} USDT\n\n"
             "⚠️ 반드시 위 <b>정확한 금액(소수점 포함)</b> 으로 송금해주세요.\n"
             "15분이내로 결제가 이루어지지 않을시 자동취소됩니다.\n"
@@ -498,25 +818,24 @@ async def text_input_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
         
     # --- 텔프유령인원 주소 입력 ---
-    if context.user_data.get("awaiting_target_telf"):
+    if s.kind == "telf" and s.state == "target":
         target = update.message.text.strip()
-        context.user_data["awaiting_target_telf"] = False
-        context.user_data["ghost_target_telf"] = target
 
-        user_id = str(update.effective_user.id)
         if user_id in pending_orders:
             pending_orders[user_id]["target_telf"] = target
             _save_state()
+        pay_address = pending_orders.get(user_id, {}).get("pay_address", PAYMENT_ADDRESS)
 
-        qty = context.user_data["ghost_qty_telf"]
-        amount = context.user_data["ghost_amount_telf"]
+        qty = s.qty
+        amount = s.amount
+        _end_session(user_id)
 
         await update.message.reply_text(
             "🧾 최종 주문 요약\n"
             f"- 텔프유령인원: {qty:,}명\n"
             f"- 대상주소: {target}\n"
             f"- 결제수단: USDT(TRC20)\n"
-            f"- 결제주소: {PAYMENT_ADDRESS}\n"
+            f"- 결제주소: {pay_address}\n"
             f"- 결제금액: {amount} USDT\n\n"
             "⚠️ 반드시 위 <b>정확한 금액(소수점 포함)</b> 으로 송금해주세요.\n"
             "15분이내로 결제가 이루어지지 않을시 자동취소됩니다.\n"
@@ -527,14 +846,15 @@ async def text_input_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
         
     # --- 조회수 링크 입력 (여러 개) ---
-    if context.user_data.get("awaiting_link_views"):
+    if s.kind == "views" and s.state == "links":
         link = update.message.text.strip()
-        context.user_data["views_links"].append(link)
+        s.links.append(link)
 
-        links = context.user_data["views_links"]
-        count = context.user_data["views_post_count"]
+        links = s.links
+        count = s.post_count
 
         if len(links) < count:
+            _save_sessions()
             await update.message.reply_text(
                 f"✅ {len(links)}개 링크 확인되었습니다.\n"
                 f"나머지 {count - len(links)}개 링크를 더 입력해주세요.",
@@ -542,31 +862,26 @@ async def text_input_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
             )
             return
         else:
-            context.user_data["awaiting_link_views_done"] = True
-            context.user_data["awaiting_link_views"] = False
-
-            qty = context.user_data["views_qty"]
+            qty = s.qty
             total_qty = qty * count
 
             # 📌 결제 금액 계산
-            blocks = total_qty // 100
-            base_amount = (PER_100_PRICE_VIEWS * Decimal(blocks)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-            unique_offset = Decimal(str(random.randint(1, 9))) / Decimal("1000")
-            amount = (base_amount + unique_offset).quantize(Decimal("0.001"), rounding=ROUND_HALF_UP)
+            amount = _order_amount(PER_100_PRICE_VIEWS, total_qty)
 
             # 상태 저장
-            context.user_data["views_amount"] = amount
-            user_id = str(update.effective_user.id)
+            _end_session(user_id)
             chat_id = update.effective_chat.id
             pending_orders[user_id] = {
                 "qty": total_qty,
                 "amount": amount,
                 "chat_id": chat_id,
                 "type": "views",
+                "pay_address": _assign_pay_address(),
                 "views_links": links,
-                "created_at": datetime.utcnow().timestamp()
+                "created_at": time.time()
             }
             _save_state()
+            _stats_order("created", pending_orders[user_id])
 
             await update.message.reply_text(
                 "🧾 최종 주문 요약\n"
@@ -574,7 +889,7 @@ async def text_input_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 f"- 총 주문량: {total_qty:,}회\n"
                 f"- 게시글 링크:\n" + "\n".join([f"{i+1}. {l}" for i, l in enumerate(links, 1)]) + "\n\n"
                 f"- 결제수단: USDT(TRC20)\n"
-                f"- 결제주소: {PAYMENT_ADDRESS}\n"
+                f"- 결제주소: {pending_orders[user_id]['pay_address']}\n"
                 f"- 결제금액: {amount} USDT\n\n"
                 "⚠️ 반드시 위 <b>정확한 금액(소수점 포함)</b> 으로 송금해주세요.\n"
                 "15분이내로 결제가 이루어지지 않을시 자동취소됩니다.\n"
@@ -585,14 +900,15 @@ async def text_input_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
             return
 
     # --- 반응 링크 입력 (여러 개) ---
-    if context.user_data.get("awaiting_link_reacts"):
+    if s.kind == "reacts" and s.state == "links":
         link = update.message.text.strip()
-        context.user_data["reacts_links"].append(link)
+        s.links.append(link)
 
-        links = context.user_data["reacts_links"]
-        count = context.user_data["reacts_post_count"]
+        links = s.links
+        count = s.post_count
 
         if len(links) < count:
+            _save_sessions()
             await update.message.reply_text(
                 f"✅ {len(links)}개 링크 확인되었습니다.\n"
                 f"나머지 {count - len(links)}개 링크를 더 입력해주세요.",
@@ -600,31 +916,26 @@ async def text_input_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
             )
             return
         else:
-            context.user_data["awaiting_link_reacts_done"] = True
-            context.user_data["awaiting_link_reacts"] = False
-
-            qty = context.user_data["reacts_qty"]
+            qty = s.qty
             total_qty = qty * count
 
             # 📌 결제 금액 계산
-            blocks = total_qty // 100
-            base_amount = (PER_100_PRICE_REACTS * Decimal(blocks)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-            unique_offset = Decimal(str(random.randint(1, 9))) / Decimal("1000")
-            amount = (base_amount + unique_offset).quantize(Decimal("0.001"), rounding=ROUND_HALF_UP)
+            amount = _order_amount(PER_100_PRICE_REACTS, total_qty)
 
             # 상태 저장
-            context.user_data["reacts_amount"] = amount
-            user_id = str(update.effective_user.id)
+            _end_session(user_id)
             chat_id = update.effective_chat.id
             pending_orders[user_id] = {
                 "qty": total_qty,
                 "amount": amount,
                 "chat_id": chat_id,
                 "type": "reacts",
+                "pay_address": _assign_pay_address(),
                 "reacts_links": links,
-                "created_at": datetime.utcnow().timestamp()
+                "created_at": time.time()
             }
             _save_state()
+            _stats_order("created", pending_orders[user_id])
 
             await update.message.reply_text(
                 "🧾 최종 주문 요약\n"
@@ -632,7 +943,7 @@ async def text_input_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 f"- 총 주문량: {total_qty:,}개\n"
                 f"- 게시글 링크:\n" + "\n".join([f"{i+1}. {l}" for i, l in enumerate(links, 1)]) + "\n\n"
                 f"- 결제수단: USDT(TRC20)\n"
-                f"- 결제주소: {PAYMENT_ADDRESS}\n"
+                f"- 결제주소: {pending_orders[user_id]['pay_address']}\n"
                 f"- 결제금액: {amount} USDT\n\n"
                 "⚠️ 반드시 위 <b>정확한 금액(소수점 포함)</b> 으로 송금해주세요.\n"
                 "15분이내로 결제가 이루어지지 않을시 자동취소됩니다.\n"
@@ -645,40 +956,265 @@ async def text_input_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # ─────────────────────────────────────────────
 # 트론스캔 API 관련 유틸
 # ─────────────────────────────────────────────
-TRONGRID_URL = (
-    f"https://api.trongrid.io/v1/accounts/{PAYMENT_ADDRESS}/transactions/trc20"
-    f"?contract_address={USDT_CONTRACT}&only_to=true"
+# ─────────────────────────────
+# 결제 수신 스트림 (수신 주소 × 토큰)
+# ─────────────────────────────
+# 추가 수신 주소 (쉼표 구분). PAYMENT_ADDRESS는 항상 첫 번째
+PAYMENT_ADDRESSES = list(dict.fromkeys(
+    [PAYMENT_ADDRESS] + [a.strip() for a in (os.getenv("PAYMENT_ADDRESSES") or "").split(",") if a.strip()]
+))
+# 추가 허용 토큰 (JSON): [{"symbol": "USDC", "contract": "T...", "decimals": 6, "price": "1.00"}]
+# price = 토큰 1개당 USDT 환산 가격
+def _parse_payment_tokens(raw: str) -> list[dict]:
+    try:
+        tokens = json.loads(raw)
+    except ValueError as e:
+        raise RuntimeError(f"PAYMENT_TOKENS가 올바른 JSON이 아닙니다: {e}") from None
+    if not isinstance(tokens, list):
+        raise RuntimeError("PAYMENT_TOKENS는 JSON 목록이어야 합니다.")
+    out = []
+    for i, t in enumerate(tokens):
+        contract = t.get("contract") if isinstance(t, dict) else None
+        if not isinstance(contract, str) or not contract.strip().startswith("T"):
+            raise RuntimeError(f"PAYMENT_TOKENS[{i}]: contract(T로 시작하는 주소)가 필요합니다.")
+        try:
+            decimals = int(t.get("decimals", 6))
+            price = Decimal(str(t.get("price", "1")))
+        except (TypeError, ValueError, InvalidOperation):
+            raise RuntimeError(f"PAYMENT_TOKENS[{i}]: decimals/price 값이 올바르지 않습니다.") from None
+        if not 0 <= decimals <= 36 or not price.is_finite() or price <= 0:
+            raise RuntimeError(f"PAYMENT_TOKENS[{i}]: decimals는 0~36, price는 0보다 커야 합니다.")
+        out.append({"symbol": str(t.get("symbol") or "?"), "contract": contract.strip(), "decimals": decimals, "price": price})
+    return out
+
+PAYMENT_TOKENS = [{"symbol": "USDT", "contract": USDT_CONTRACT, "decimals": 6, "price": Decimal("1")}] + _parse_payment_tokens(
+    os.getenv("PAYMENT_TOKENS") or "[]"
 )
 
-HEADERS = {
-    "accept": "application/json",
-    "TRON-PRO-API-KEY": os.getenv("TRON_API_KEY")  # <- TronGrid에서 발급받은 키
-}
-def _extract_amount(tx: dict):
-    return (
-        tx.get("amount") or
-        tx.get("amount_str") or
-        tx.get("amountUInt64") or
-        tx.get("quant") or
-        tx.get("value") or
-        tx.get("tokenValue") or
-        tx.get("raw_data", {}).get("contract", [{}])[0].get("parameter", {}).get("value", {}).get("amount")
-    )
-
-def _to_decimal_amount(raw, token_decimals: int):
-    if raw is None:
-        return None
+class PaymentStream:
+    """(수신 주소, 토큰 컨트랙트) 1쌍의 증분 조회 상태"""
+    __slots__ = ("address", "contract", "symbol", "decimals", "price", "last_seen_ts")
+
+    def __init__(self, address: str, contract: str, symbol: str, decimals: int, price: Decimal):
+        self.address = address
+        self.contract = contract
+        self.symbol = symbol
+        self.decimals = decimals
+        self.price = price
+        self.last_seen_ts = 0
+
+    @property
+    def key(self) -> str:
+        return f"{self.address}:{self.contract}"
+
+    @property
+    def trongrid_url(self) -> str:
+        return (
+            f"https://api.trongrid.io/v1/accounts/{self.address}/transactions/trc20"
+            f"?contract_address={self.contract}&only_to=true"
+        )
+
+    @property
+    def events_url(self) -> str:
+        return f"https://api.trongrid.io/v1/contracts/{self.contract}/events?event_name=Transfer&limit=20"
+
+    @property
+    def tronscan_url(self) -> str:
+        return (
+            f"https://apilist.tronscanapi.com/api/token_trc20/transfers"
+            f"?toAddress={self.address}&contract_address={self.contract}&limit=20&start=0"
+        )
+
+PAYMENT_STREAMS = [
+    PaymentStream(addr, t["contract"], t["symbol"], t["decimals"], t["price"])
+    for addr in PAYMENT_ADDRESSES
+    for t in PAYMENT_TOKENS
+]
+log.info("📡 STREAMS | %s", [f"{st.address[:8]}…/{st.symbol}" for st in PAYMENT_STREAMS])
+
+def _assign_pay_address() -> str:
+    """보류 주문이 가장 적은 수신 주소 배정 (동률이면 앞 주소)"""
+    load = dict.fromkeys(PAYMENT_ADDRESSES, 0)
+    for order in pending_orders.values():
+        addr = order.get("pay_address")
+        if addr in load:
+            load[addr] += 1
+    return min(PAYMENT_ADDRESSES, key=load.__getitem__)
+
+# ─────────────────────────────
+# 블록체인 API HTTP 클라이언트 (API 키 풀 / 속도 제한 / 서킷 브레이커)
+# ─────────────────────────────
+# TronGrid에서 발급받은 키, 여러 개면 쉼표로 구분
+TRON_API_KEYS = [k.strip() for k in (os.getenv("TRON_API_KEYS") or os.getenv("TRON_API_KEY") or "").split(",") if k.strip()]
+TRON_KEY_RPS = float(os.getenv("TRON_KEY_RPS", "10") or "10")                  # 키당 초당 요청 수 (TronGrid 한도 15 QPS)
+TRON_KEY_DAILY = int(os.getenv("TRON_KEY_DAILY", "100000") or "100000")        # 키당 일일 요청 한도
+TRON_MAX_WAIT = float(os.getenv("TRON_MAX_WAIT", "10") or "10")                # 모든 키가 막혔을 때 최대 대기(초)
+BREAKER_FAILS = int(os.getenv("BREAKER_FAILS", "5") or "5")                    # 연속 실패 시 차단
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30") or "30")          # 차단 유지 시간(초)
+STREAM_CHUNK = 64 * 1024                                                        # 응답 본문 스트리밍 단위(바이트)
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+class ApiKey:
+    __slots__ = ("key", "bucket", "day", "used", "blocked_until")
+
+    def __init__(self, key: str):
+        self.key = key
+        self.bucket = TokenBucket(TRON_KEY_RPS, TRON_KEY_RPS)
+        self.day = ""
+        self.used = 0
+        self.blocked_until = 0.0
+
+    def wait_time(self, now: float, today: str) -> float:
+        if self.day != today:
+            self.day, self.used = today, 0
+        if self.used >= TRON_KEY_DAILY:
+            return float("inf")
+        return max(self.blocked_until - now, self.bucket.wait_time(now))
+
+class CircuitBreaker:
+    """엔드포인트별 연속 실패 카운트. 열림 상태에서는 쿨다운 후 1회만 시험 요청 허용"""
+    __slots__ = ("fails", "open_until")
+
+    def __init__(self):
+        self.fails = 0
+        self.open_until = 0.0
+
+    def allow(self, now: float) -> bool:
+        if now < self.open_until:
+            return False
+        if self.fails >= BREAKER_FAILS:
+            # 반열림: 이번 요청 1건만 통과시키고 결과가 나올 때까지(최대 쿨다운) 다른 요청은 차단
+            self.open_until = now + BREAKER_COOLDOWN
+        return True
+
+    def success(self):
+        self.fails = 0
+        self.open_until = 0.0
+
+    def failure(self, now: float, cooldown: float = BREAKER_COOLDOWN):
+        self.fails += 1
+        if self.fails >= BREAKER_FAILS:
+            self.open_until = now + cooldown
+
+    def block(self, until: float):
+        self.open_until = max(self.open_until, until)
+
+def _retry_after(resp) -> float:
     try:
-        s = str(raw)
-        if s.startswith("0x"):  # HEX 값
-            val = int(s, 16)
-            return (Decimal(val) / (Decimal(10) ** token_decimals)).quantize(Decimal("0.000000"))
-        if s.isdigit():  # 정수 문자열
-            return (Decimal(s) / (Decimal(10) ** token_decimals)).quantize(Decimal("0.000000"))
-        return Decimal(s)
-    except (InvalidOperation, ValueError):
+        return max(0.0, float(resp.headers.get("Retry-After", "1")))
+    except ValueError:
+        return 1.0
+
+class TronClient:
+    """모든 블록체인 조회가 공유하는 keep-alive 세션 + API 키 순환"""
+    def __init__(self, keys: list[str]):
+        self.keys = [ApiKey(k) for k in keys]
+        self.breakers: dict[str, CircuitBreaker] = {}
+        self.session = None
+
+    async def start(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=32, limit_per_host=16, ttl_dns_cache=300, use_dns_cache=True, keepalive_timeout=60,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=30, connect=10),
+                headers={"accept": "application/json"},
+            )
+        return self
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _breaker(self, url: str) -> CircuitBreaker:
+        u = urlsplit(url)
+        return self.breakers.setdefault(f"{u.netloc}{u.path}", CircuitBreaker())
+
+    async def _acquire_key(self):
+        """대기 시간이 가장 짧은 키를 골라 토큰 1개 사용. TRON_MAX_WAIT 내에 쓸 키가 없으면 None"""
+        while True:
+            now = time.monotonic()
+            today = datetime.utcnow().strftime("%Y%m%d")
+            wait, key = min(((k.wait_time(now, today), i) for i, k in enumerate(self.keys)), default=(float("inf"), -1))
+            if wait <= 0:
+                k = self.keys[key]
+                k.bucket.take(now)
+                k.used += 1
+                return k
+            if wait > TRON_MAX_WAIT:
+                return None
+            await asyncio.sleep(wait)
+
+    async def get_json(self, url: str, use_key: bool = True, method: str = "GET", payload=None, decoder=None):
+        """
+        성공 시 JSON, 실패/차단 시 None. 429는 Retry-After 만큼 해당 키를 쉬게 하고 다른 키로 재시도.
+        decoder(팩토리)를 주면 본문 전체를 읽지 않고 청크 단위로 넘긴 뒤 decoder.finish() 결과를 반환.
+        """
+        await self.start()
+        breaker = self._breaker(url)
+        if not breaker.allow(time.monotonic()):
+            log.debug("[API_SKIP] circuit open %s", url)
+            return None
+
+        use_key = use_key and bool(self.keys)
+        for _ in range(len(self.keys) + 1 if use_key else 1):
+            key = await self._acquire_key() if use_key else None
+            if use_key and key is None:
+                log.warning("[API_THROTTLED] 사용 가능한 API 키 없음 url=%s", url)
+                return None
+            headers = {"TRON-PRO-API-KEY": key.key} if key else None
+            try:
+                async with self.session.request(method, url, headers=headers, json=payload) as resp:
+                    if resp.status == 429:
+                        retry = _retry_after(resp)
+                        log.warning("[API_429] %s retry_after=%ss key=%s", url, retry, key.key[:8] if key else "-")
+                        if key:
+                            key.blocked_until = time.monotonic() + retry
+                            continue
+                        breaker.block(time.monotonic() + retry)
+                        return None
+                    if resp.status != 200:
+                        log.warning("[API_FAIL] %s HTTP %s", url, resp.status)
+                        breaker.failure(time.monotonic())
+                        return None
+                    if decoder is None:
+                        data = await resp.json(content_type=None)
+                    else:
+                        dec = decoder()
+                        async for chunk in resp.content.iter_chunked(STREAM_CHUNK):
+                            dec.feed(chunk)
+                        data = dec.finish()
+                    breaker.success()
+                    return data
+            except Exception as e:
+                log.error("[API_ERROR] url=%s err=%s", url, e)
+                breaker.failure(time.monotonic())
+                return None
         return None
 
+tron_client = TronClient(TRON_API_KEYS)
+
 def _nearest_pending(amount, n=3):
     """가장 가까운 금액 순으로 n개 pending order 반환"""
     try:
@@ -690,267 +1226,1644 @@ def _nearest_pending(amount, n=3):
     except Exception:
         return []
 
+# ─────────────────────────────
+# 송금 주소별 입금 원장 (부분/분할 결제 합산)
+# ─────────────────────────────
+LEDGER_WINDOW = int(os.getenv("LEDGER_WINDOW", "900") or "900")   # 합산 대상 기간(초), 기본 = 결제 제한시간
+LEDGER_MAX_OVERPAY = _dec(os.getenv("LEDGER_MAX_OVERPAY", "1.2"))   # 합산 매칭 허용 상한 (주문 금액 배수)
+
+def _ts_seconds(ts) -> float:
+    """API 타임스탬프(ms/초 혼재)를 초 단위로 통일"""
+    ts = float(ts or 0)
+    return ts / 1000 if ts > 1e11 else ts
+
+class SenderLedger:
+    """
+    from_address 별 최근 입금 내역과 누적 합계. 기간이 지난 내역은 오래된 것부터 제거.
+    내역마다 누적액(cum)을 같이 두어 특정 시각 이후 합계를 이분 탐색 한 번으로 계산
+    """
+    def __init__(self, window: int):
+        self.window = window
+        self.entries: dict[str, deque] = {}     # addr -> deque[(ts, amount, txid, cum)] (ts 오름차순)
+        self.base: dict[str, Decimal] = {}      # addr -> 첫 내역 직전까지의 누적액 (제거된 내역 합)
+        self.arrivals: deque = deque()          # (ts, addr, txid) 도착 순서 (만료 처리용)
+        self.txids: set[str] = set()            # 원장에 남아 있는 TXID (재반영 중복 방지)
+
+    def evict(self, now: float):
+        while self.arrivals and self.arrivals[0][0] < now - self.window:
+            _, addr, txid = self.arrivals.popleft()
+            q = self.entries.get(addr)
+            if q and q[0][2] == txid:
+                self.base[addr] = q.popleft()[3]
+                self.txids.discard(txid)
+                if not q:
+                    del self.entries[addr]
+                    del self.base[addr]
+
+    def add(self, addr: str, ts: float, amount: Decimal, txid: str):
+        if txid in self.txids:
+            return
+        self.evict(ts)
+        self.txids.add(txid)
+        self.arrivals.append((ts, addr, txid))
+        q = self.entries.get(addr)
+        if q is None:
+            self.entries[addr] = deque([(ts, amount, txid, amount)])
+            self.base[addr] = Decimal("0")
+        elif ts >= q[-1][0]:
+            q.append((ts, amount, txid, q[-1][3] + amount))
+        else:
+            # 늦게 도착한 과거 입금: 시각 순서를 유지하도록 끼워 넣고 뒤쪽 누적액 재계산
+            rows = sorted([(t, a, x) for t, a, x, _ in q] + [(ts, amount, txid)], key=lambda r: r[0])
+            cum = self.base[addr]
+            q.clear()
+            for t, a, x in rows:
+                cum += a
+                q.append((t, a, x, cum))
+
+    def total(self, addr: str) -> Decimal:
+        q = self.entries.get(addr)
+        return q[-1][3] - self.base[addr] if q else Decimal("0")
+
+    def _start(self, q: deque, t0: float) -> int:
+        return bisect.bisect_left(q, t0, key=lambda e: e[0])
+
+    def since(self, addr: str, t0: float) -> tuple[Decimal, int]:
+        """t0 이후 입금 합계와 건수 (누적액 차이로 계산)"""
+        q = self.entries.get(addr)
+        if not q:
+            return Decimal("0"), 0
+        i = self._start(q, t0)
+        return q[-1][3] - (q[i - 1][3] if i else self.base[addr]), len(q) - i
+
+    def txids_since(self, addr: str, t0: float) -> list[str]:
+        q = self.entries.get(addr) or deque()
+        return [q[i][2] for i in range(self._start(q, t0), len(q))]
+
+    def consume(self, addr: str):
+        """주문에 사용된 송금 주소의 내역 제거 (arrivals 쪽은 evict 시 건너뜀)"""
+        self.txids.difference_update(e[2] for e in self.entries.get(addr, ()))
+        self.entries.pop(addr, None)
+        self.base.pop(addr, None)
+
+    def dump(self) -> list:
+        return [[addr, ts, str(amount), txid] for addr, q in self.entries.items() for ts, amount, txid, _ in q]
+
+    def restore(self, rows: list):
+        self.entries.clear()
+        self.base.clear()
+        self.arrivals.clear()
+        self.txids.clear()
+        for addr, ts, amount, txid in sorted(rows, key=lambda r: r[1]):
+            self.add(addr, float(ts), Decimal(amount), txid)
+
+sender_ledger = SenderLedger(LEDGER_WINDOW)
+sender_credits: dict[str, Decimal] = {}   # 초과 입금액 (송금 주소별 누적, 다음 주문 부족분에 사용)
+
+def _add_credit(addr: str, amount: Decimal):
+    sender_credits[addr] = sender_credits.get(addr, Decimal("0")) + amount
+    log.info("[CREDIT] addr=%s +%s → %s", addr, amount, sender_credits[addr])
+
+def _use_credit(addr: str, amount: Decimal):
+    left = sender_credits.get(addr, Decimal("0")) - amount
+    if left > AMOUNT_TOLERANCE:
+        sender_credits[addr] = left
+    else:
+        sender_credits.pop(addr, None)
+    log.info("[CREDIT] addr=%s -%s → %s", addr, amount, max(left, Decimal("0")))
+
+def _match_transfer(orders: dict, ledger: SenderLedger, txid: str, from_addr: str, amount: Decimal, ts,
+                    to_addr: str = "", credits: dict | None = None):
+    """
+    입금 1건을 보류 주문과 매칭. 단건 금액이 맞으면 바로 매칭하고,
+    아니면 송금 주소 원장에 넣은 뒤 주문 생성 이후 같은 주소의 입금 누적액(단건 포함)이
+    주문 금액 ~ 주문 금액 × LEDGER_MAX_OVERPAY 범위인지 확인 (그 밖은 미매칭으로 운영자에게 알림).
+    누적액이 모자라면 같은 주소의 크레딧(credits)으로 부족분을 채움.
+    주문에 수신 주소가 배정돼 있으면 그 주소로 들어온 입금만 매칭.
+    반환: (uid, order, txids, 입금 합계, 사용한 크레딧) 또는 None
+    """
+    if to_addr:
+        orders = {uid: o for uid, o in orders.items() if o.get("pay_address", to_addr) == to_addr}
+
+    actual = amount.quantize(Decimal("0.01"))
+    for uid, order in orders.items():
+        expected = order["amount"].quantize(Decimal("0.01"))
+        if abs(expected - actual) <= AMOUNT_TOLERANCE:
+            return uid, order, [txid], amount, Decimal("0")
+
+    if not from_addr:
+        return None
+    ledger.add(from_addr, _ts_seconds(ts), amount, txid)
+    credit = (credits or {}).get(from_addr, Decimal("0"))
+
+    best = None
+    for uid, order in orders.items():
+        paid, count = ledger.since(from_addr, order.get("created_at", 0))
+        if not count or paid > order["amount"] * LEDGER_MAX_OVERPAY:
+            continue
+        used = min(credit, max(Decimal("0"), order["amount"] - paid))
+        if paid + used + AMOUNT_TOLERANCE < order["amount"]:
+            continue
+        # 여러 주문이 가능하면 초과액이 가장 적은 주문 선택
+        if best is None or order["amount"] > best[1]["amount"]:
+            best = (uid, order, paid, used)
+    if best is None:
+        return None
+    uid, order, paid, used = best
+    txids = ledger.txids_since(from_addr, order.get("created_at", 0))
+    ledger.consume(from_addr)
+    return uid, order, txids, paid, used
+
 # ─────────────────────────────
 # TronGrid / TronScan API 공통 조회 함수
 # ─────────────────────────────
-async def fetch_txs(session, url, headers=None):
+class Transfer:
+    """
+    관련 입금 1건. raw는 토큰 최소 단위 정수이고
+    토큰 수량/USDT 환산 금액은 스트림 정보(decimals, price)로 필요할 때 계산
+    """
+    __slots__ = ("txid", "from_addr", "to_addr", "contract", "raw", "ts", "stream")
+
+    def __init__(self, txid, from_addr, to_addr, contract, raw, ts, stream):
+        self.txid = txid
+        self.from_addr = from_addr
+        self.to_addr = to_addr
+        self.contract = contract
+        self.raw = raw
+        self.ts = ts
+        self.stream = stream
+
+    @property
+    def symbol(self) -> str:
+        return self.stream.symbol
+
+    @property
+    def token_amount(self) -> Decimal:
+        return Decimal(self.raw) / (Decimal(10) ** self.stream.decimals)
+
+    @property
+    def amount(self) -> Decimal:
+        return (self.token_amount * self.stream.price).quantize(Decimal("0.000001"))
+
+def _raw_int(value):
     try:
-        async with session.get(url, headers=headers, timeout=30) as resp:
-            if resp.status != 200:
-                log.warning("[API_FAIL] %s HTTP %s", url, resp.status)
-                return []
-            data = await resp.json()
-
-            # TronGrid 응답 구조
-            if "data" in data:
-                return data["data"]
-            # TronScan 응답 구조
-            if "token_transfers" in data:
-                return data["token_transfers"]
-            if "trc20_transfers" in data:
-                return data["trc20_transfers"]
+        s = str(value)
+        return int(s, 16) if s.startswith("0x") else int(s)
+    except (TypeError, ValueError):
+        return None
 
-            return []
-    except Exception as e:
-        log.error("[API_ERROR] url=%s err=%s", url, e)
+class TransferDecoder(abc.ABC):
+    """
+    응답 본문을 받는 대로 이어 붙이면서 목록 배열의 원소를 하나씩 raw_decode 하고,
+    원소는 곧바로 parse()로 Transfer 또는 None(관련 없음)으로 바꿔 dict를 남기지 않는다.
+    """
+    ARRAY_RE = re.compile(r'"(?:data|token_transfers|trc20_transfers)"\s*:\s*\[')
+    _json = json.JSONDecoder()
+
+    def __init__(self, stream: PaymentStream):
+        self.stream = stream
+        self.since = stream.last_seen_ts
+        self.text = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.started = False     # 목록 배열 '[' 이후인지
+        self.done = False        # 배열 ']' 까지 읽었는지
+        self.out: list[Transfer] = []
+
+    def feed(self, chunk: bytes):
+        if self.done:
+            return
+        buf = self.buf + self.text.decode(chunk)
+        pos = 0
+        if not self.started:
+            m = self.ARRAY_RE.search(buf)
+            if not m:
+                self.buf = buf
+                return
+            self.started, pos = True, m.end()
+
+        n = len(buf)
+        while True:
+            while pos < n and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= n:
+                break
+            if buf[pos] == "]":
+                self.done = True
+                break
+            try:
+                item, pos_end = self._json.raw_decode(buf, pos)
+            except ValueError:
+                break   # 원소가 아직 다 들어오지 않음
+            pos = pos_end
+            t = self.parse(item)
+            if t is not None:
+                self.out.append(t)
+        self.buf = "" if self.done else buf[pos:]
+
+    def finish(self) -> list[Transfer]:
+        self.feed(b"")
+        if self.started and not self.done:
+            raise ValueError("응답 본문이 목록 중간에 끊김")
+        return self.out
+
+    def transfer(self, txid, from_addr, raw, ts):
+        raw = _raw_int(raw)
+        if not txid or raw is None or ts < self.since:
+            return None
+        st = self.stream
+        return Transfer(txid, from_addr or "", st.address, st.contract, raw, ts, st)
+
+    @abc.abstractmethod
+    def parse(self, item: dict):
+        """응답 원소 1건 → Transfer, 이 스트림과 무관하면 None"""
+
+class TronGridDecoder(TransferDecoder):
+    """/v1/accounts/{addr}/transactions/trc20"""
+    def parse(self, tx: dict):
+        st = self.stream
+        if tx.get("to") != st.address or tx.get("type", "Transfer") != "Transfer":
+            return None
+        if (tx.get("token_info") or {}).get("address", st.contract) != st.contract:
+            return None
+        return self.transfer(tx.get("transaction_id"), tx.get("from"), tx.get("value"), tx.get("block_timestamp") or 0)
+
+class TronGridEventsDecoder(TransferDecoder):
+    """/v1/contracts/{contract}/events — 컨트랙트 전체 Transfer 이벤트, 주소는 hex"""
+    def __init__(self, stream: PaymentStream):
+        super().__init__(stream)
+        self.to_hex = _b58_to_hex20(stream.address)
+
+    def parse(self, ev: dict):
+        st = self.stream
+        if ev.get("event_name") != "Transfer" or ev.get("contract_address", st.contract) != st.contract:
+            return None
+        result = ev.get("result") or {}
+        to = result.get("to") or ""
+        if to != st.address and to[-40:].lower() != self.to_hex:
+            return None
+        sender = result.get("from") or ""
+        if sender and not sender.startswith("T"):
+            sender = _hex20_to_b58(sender)
+        return self.transfer(ev.get("transaction_id"), sender, result.get("value"), ev.get("block_timestamp") or 0)
+
+class TronScanDecoder(TransferDecoder):
+    """apilist.tronscanapi.com /api/token_trc20/transfers"""
+    def parse(self, tx: dict):
+        st = self.stream
+        if tx.get("to_address") != st.address or tx.get("revert"):
+            return None
+        if tx.get("contract_address", st.contract) != st.contract:
+            return None
+        ts = tx.get("block_ts") or tx.get("timestamp") or 0
+        return self.transfer(tx.get("transaction_id"), tx.get("from_address"), tx.get("quant"), ts)
+
+async def fetch_txs(client, url, decoder, use_key=True):
+    """조회 실패 시 None, 성공했지만 새 입금이 없으면 [] (실패일 때만 다음 소스로 넘어감)"""
+    return await client.get_json(url, use_key=use_key, decoder=decoder)
+
+async def _poll_stream(stream: PaymentStream) -> list[Transfer]:
+    """스트림 1개 조회 (TronGrid → events → TronScan 순 폴백), 커서 이후 입금만 반환"""
+    # 1) TronGrid 기본 transactions/trc20
+    txs = await fetch_txs(tron_client, stream.trongrid_url, functools.partial(TronGridDecoder, stream))
+
+    # 2) TronGrid events fallback
+    if txs is None:
+        txs = await fetch_txs(tron_client, stream.events_url, functools.partial(TronGridEventsDecoder, stream))
+
+    # 3) TronScan fallback
+    if txs is None:
+        txs = await fetch_txs(tron_client, stream.tronscan_url, functools.partial(TronScanDecoder, stream), use_key=False)
+    txs = txs or []
+
+    # 최초 실행 시 타임스탬프 초기화
+    if stream.last_seen_ts == 0 and txs:
+        stream.last_seen_ts = max(t.ts for t in txs)
+        log.info("[INIT] %s last_seen_ts 초기화=%s", stream.key, stream.last_seen_ts)
         return []
 
+    # 커서는 결제 루프가 이 입금들을 아웃박스에 기록한 뒤에 전진 (_advance_stream_cursors)
+    return txs
+
+def _advance_stream_cursors(transfers: list[Transfer]) -> bool:
+    moved = False
+    for t in transfers:
+        if t.ts > t.stream.last_seen_ts:
+            t.stream.last_seen_ts = t.ts
+            moved = True
+    return moved
+
 # ─────────────────────────────
-# 결제 감지 & 매칭 루프
+# TRON 풀노드 직접 블록 스캔 (INGEST_MODE=node)
 # ─────────────────────────────
-last_seen_ts = 0
-seen_txids = set()   # 같은 타임스탬프라도 TXID 단위로 중복 처리 방지
+INGEST_MODE = (os.getenv("INGEST_MODE") or "indexer").strip().lower()       # indexer | node
+TRON_NODE_URL = (os.getenv("TRON_NODE_URL") or "http://127.0.0.1:8090").rstrip("/")
+NODE_CONFIRMATIONS = int(os.getenv("NODE_CONFIRMATIONS", "19") or "19")    # 이만큼 확정된 블록까지만 처리
+NODE_BATCH = int(os.getenv("NODE_BATCH", "20") or "20")                    # 1회 조회 블록 수
+NODE_START_BLOCK = int(os.getenv("NODE_START_BLOCK", "0") or "0")         # 저장된 커서가 없을 때 이 블록부터 스캔 (0이면 현재 확정 블록부터)
+NODE_KEEP_HASHES = 64                                                      # 재구성(reorg) 확인용 최근 블록 해시 수
+
+# keccak256("Transfer(address,address,uint256)")
+TRANSFER_TOPIC = "ddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
+B58_ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+def _b58_to_hex20(addr: str) -> str:
+    """T... 주소 → 로그에 쓰이는 20바이트 hex (41 접두어/체크섬 제외, 소문자)"""
+    n = 0
+    for ch in addr:
+        n = n * 58 + B58_ALPHABET.index(ch)
+    raw = n.to_bytes(25, "big")
+    return raw[1:21].hex()
+
+def _hex20_to_b58(h: str) -> str:
+    payload = bytes.fromhex("41" + h[-40:])
+    checksum = hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4]
+    n = int.from_bytes(payload + checksum, "big")
+    out = ""
+    while n:
+        n, r = divmod(n, 58)
+        out = B58_ALPHABET[r] + out
+    return out
+
+class NodeScanner:
+    """
+    풀노드 HTTP API로 확정 블록을 묶음 조회하고 TRC20 Transfer 로그를 직접 디코딩.
+    topic/수신 주소/컨트랙트를 먼저 문자열로 걸러 관련 없는 로그는 파싱하지 않음.
+    """
+    def __init__(self, streams: list, base_url: str):
+        self.base_url = base_url
+        self.use_key = "trongrid.io" in base_url
+        # (수신 주소 hex, 컨트랙트 hex) → 스트림
+        self.streams = {(_b58_to_hex20(st.address), _b58_to_hex20(st.contract)): st for st in streams}
+        self.to_hex = {k[0] for k in self.streams}
+        self.cursor = 0                       # 마지막으로 처리한 블록 번호
+        self.hashes: dict[int, str] = {}      # 블록 번호 → blockID (최근 NODE_KEEP_HASHES개)
+        self.staged = None                    # poll() 결과를 처리한 뒤 commit() 할 (마지막 블록, 블록 해시)
+
+    async def _post(self, path: str, payload: dict):
+        return await tron_client.get_json(f"{self.base_url}{path}", use_key=self.use_key, method="POST", payload=payload)
+
+    async def head(self):
+        data = await self._post("/wallet/getnowblock", {})
+        try:
+            return int(data["block_header"]["raw_data"]["number"])
+        except (TypeError, KeyError, ValueError):
+            return None
+
+    def decode(self, infos: list) -> list:
+        out = []
+        for info in infos or ():
+            for lg in info.get("log") or ():
+                topics = lg.get("topics") or ()
+                if len(topics) < 3 or topics[0] != TRANSFER_TOPIC:
+                    continue
+                to_hex = topics[2][-40:].lower()
+                if to_hex not in self.to_hex:
+                    continue
+                stream = self.streams.get((to_hex, (lg.get("address") or "")[-40:].lower()))
+                if stream is None:
+                    continue
+                out.append(Transfer(
+                    info["id"], _hex20_to_b58(topics[1]), stream.address, stream.contract,
+                    int(lg.get("data") or "0", 16), info.get("blockTimeStamp") or 0, stream,
+                ))
+        return out
+
+    async def poll(self) -> list:
+        head = await self.head()
+        if head is None:
+            return []
+        safe = head - NODE_CONFIRMATIONS
+        if self.cursor == 0:
+            self.cursor = min(safe, NODE_START_BLOCK - 1) if NODE_START_BLOCK > 0 else safe
+            log.info("[NODE_INIT] cursor=%s head=%s", self.cursor, head)
+            return []
+        if safe <= self.cursor:
+            return []
 
-async def check_tron_payments(app):
-    global last_seen_ts, seen_txids
+        start, end = self.cursor + 1, min(safe, self.cursor + NODE_BATCH)
+        data = await self._post("/wallet/getblockbylimitnext", {"startNum": start, "endNum": end + 1})
+        blocks = sorted((data or {}).get("block") or [], key=lambda b: b["block_header"]["raw_data"]["number"])
+        if len(blocks) != end - start + 1:
+            log.warning("[NODE] 블록 범위 조회 실패 %s~%s", start, end)
+            return []
 
-    async with aiohttp.ClientSession() as session:
-        while True:
-            try:
-                # 1) TronGrid 기본 transactions/trc20
-                txs = await fetch_txs(session, TRONGRID_URL, HEADERS)
-
-                # 2) TronGrid events fallback
-                if not txs:
-                    alt_url = f"https://api.trongrid.io/v1/contracts/{USDT_CONTRACT}/events?event_name=Transfer&limit=20"
-                    txs = await fetch_txs(session, alt_url, HEADERS)
-
-                # 3) TronScan fallback
-                if not txs:
-                    txs = await fetch_txs(session, TRONSCAN_URL)
-
-                # 최초 실행 시 타임스탬프 초기화
-                if last_seen_ts == 0 and txs:
-                    last_seen_ts = max(tx.get("block_timestamp") or tx.get("timestamp") or 0 for tx in txs)
-                    log.info("[INIT] last_seen_ts 초기화=%s", last_seen_ts)
-                    await asyncio.sleep(5)
+        # 이전에 처리한 마지막 블록과 이어지는지 확인, 아니면 되감기
+        parent = blocks[0]["block_header"]["raw_data"].get("parentHash")
+        known = self.hashes.get(self.cursor)
+        if known and parent and parent != known:
+            rewind = max(0, self.cursor - NODE_CONFIRMATIONS)
+            log.warning("[NODE_REORG] cursor=%s → %s", self.cursor, rewind)
+            self.cursor = rewind
+            self.hashes = {n: h for n, h in self.hashes.items() if n <= rewind}
+            return []
+
+        infos = await asyncio.gather(*(
+            self._post("/wallet/gettransactioninfobyblocknum", {"num": n}) for n in range(start, end + 1)
+        ))
+        if any(i is None for i in infos):
+            log.warning("[NODE] 트랜잭션 정보 조회 실패 %s~%s", start, end)
+            return []
+
+        out = [t for block_infos in infos for t in self.decode(block_infos)]
+        self.staged = (end, {b["block_header"]["raw_data"]["number"]: b["blockID"] for b in blocks})
+        log.debug("[NODE] blocks %s~%s transfers=%s", start, end, len(out))
+        return out
+
+    def commit(self) -> bool:
+        """poll()로 받은 입금이 모두 아웃박스에 기록된 뒤 커서 전진"""
+        if self.staged is None:
+            return False
+        end, hashes = self.staged
+        self.staged = None
+        self.hashes.update(hashes)
+        for n in [n for n in self.hashes if n <= end - NODE_KEEP_HASHES]:
+            del self.hashes[n]
+        self.cursor = end
+        return True
+
+    def dump(self) -> dict:
+        return {"cursor": self.cursor, "hashes": {str(n): h for n, h in self.hashes.items()}}
+
+    def restore(self, data: dict):
+        self.cursor = int(data.get("cursor") or 0)
+        self.hashes = {int(n): h for n, h in (data.get("hashes") or {}).items()}
+
+node_scanner = NodeScanner(PAYMENT_STREAMS, TRON_NODE_URL)
+
+# ─────────────────────────────
+# 운영자 알림 묶음 (다이제스트)
+# ─────────────────────────────
+ADMIN_DIGEST_WINDOW = int(os.getenv("ADMIN_DIGEST_WINDOW", "60") or "60")   # 묶음 전송 주기(초), 0이면 즉시 전송
+ADMIN_URGENT_AMOUNT = _dec(os.getenv("ADMIN_URGENT_AMOUNT", "100"))          # 이 금액 이상 미매칭은 즉시 전송
+ADMIN_DIGEST_KEEP = 50      # /digest 로 조회 가능한 최근 묶음 수
+ADMIN_DIGEST_LINES = 20     # 묶음 메시지 1개에 표시할 최대 줄 수
+ADMIN_DIGEST_FILE = BASE_DIR / "admin_digest.json"   # 아직 전송되지 않은 알림 (재시작 시 복원)
+
+DIGEST_LABELS = {
+    "unmatched": "미매칭 결제",
+    "no_order": "주문 없는 결제",
+    "expired": "시간초과 취소",
+}
+
+class AdminDigest:
+    """
+    주기 내 운영자 알림을 모아 두었다가 요약 1건으로 전송.
+    전송 전 알림은 파일에 남겨 두므로 아웃박스가 add() 직후 오프셋을 넘겨도 재시작 시 유실되지 않음.
+    """
+    def __init__(self, keep: int, path: Path):
+        self.path = path
+        self.events: list[tuple[str, str, str]] = []   # (kind, 요약 한 줄, 전체 내용)
+        self.history: deque = deque(maxlen=keep)      # (digest_id, events)
+        self.seq = 0
+
+    def _save(self):
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"seq": self.seq, "events": self.events}, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+    def load(self):
+        if not self.path.exists():
+            return
+        try:
+            data = json.loads(self.path.read_text(encoding="utf-8"))
+            self.seq = int(data.get("seq") or 0)
+            self.events = [tuple(e) for e in data.get("events") or []]
+            log.info("[DIGEST] restored pending=%s", len(self.events))
+        except Exception as e:
+            log.error("[DIGEST_LOAD_ERROR] %s", e)
+
+    def add(self, kind: str, summary: str, detail: str):
+        self.events.append((kind, summary, detail))
+        self._save()
+
+    def drain(self, n: int):
+        """전송이 끝난 앞쪽 n건을 요약 기록으로 옮김"""
+        self.seq += 1
+        events, self.events = self.events[:n], self.events[n:]
+        self.history.append((self.seq, events))
+        self._save()
+        return self.seq, events
+
+    def get(self, digest_id=None):
+        if not self.history:
+            return None
+        if digest_id is None:
+            return self.history[-1]
+        for item in self.history:
+            if item[0] == digest_id:
+                return item
+        return None
+
+admin_digest = AdminDigest(ADMIN_DIGEST_KEEP, ADMIN_DIGEST_FILE)
+
+def _chunk_text(text: str, limit: int = 4000):
+    """텔레그램 메시지 길이 제한에 맞춰 줄 단위로 분할"""
+    chunk = ""
+    for line in text.split("\n"):
+        if chunk and len(chunk) + len(line) + 1 > limit:
+            yield chunk
+            chunk = ""
+        chunk = f"{chunk}\n{line}" if chunk else line
+    if chunk:
+        yield chunk
+
+async def notify_admin(bot, kind: str, summary: str, detail: str, urgent: bool = False):
+    if not ADMIN_CHAT_ID:
+        return
+    if urgent or ADMIN_DIGEST_WINDOW <= 0:
+        await bot.send_message(ADMIN_CHAT_ID, detail)
+        return
+    admin_digest.add(kind, summary, detail)
+
+async def _flush_admin_digest(context: ContextTypes.DEFAULT_TYPE):
+    events = list(admin_digest.events)
+    if not events:
+        return
+    digest_id = admin_digest.seq + 1
+
+    counts: dict[str, int] = {}
+    for kind, _, _ in events:
+        counts[kind] = counts.get(kind, 0) + 1
+
+    lines = [f"📋 [운영 알림 요약 #{digest_id}] 최근 {ADMIN_DIGEST_WINDOW}초"]
+    lines += [f"- {DIGEST_LABELS.get(k, k)}: {n}건" for k, n in counts.items()]
+    lines.append("")
+    lines += [f"• {summary}" for _, summary, _ in events[:ADMIN_DIGEST_LINES]]
+    if len(events) > ADMIN_DIGEST_LINES:
+        lines.append(f"… 외 {len(events) - ADMIN_DIGEST_LINES}건")
+    lines.append(f"👉 전체 내용: /digest {digest_id}")
+
+    try:
+        await context.bot.send_message(ADMIN_CHAT_ID, "\n".join(lines))
+    except Exception as e:
+        # 보낸 것으로 치지 않음 → 다음 주기에 (새 알림과 함께) 다시 전송
+        log.error("[DIGEST_SEND_ERROR] id=%s err=%s", digest_id, e)
+        return
+    admin_digest.drain(len(events))
+
+def _is_admin(update: Update) -> bool:
+    return bool(ADMIN_CHAT_ID) and update.effective_chat is not None and update.effective_chat.id == ADMIN_CHAT_ID
+
+async def digest_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not _is_admin(update):
+        return
+    try:
+        digest_id = int(context.args[0]) if context.args else None
+    except ValueError:
+        await update.message.reply_text("사용법: /digest [번호]")
+        return
+
+    item = admin_digest.get(digest_id)
+    if item is None:
+        await update.message.reply_text("조회 가능한 알림 요약이 없습니다.")
+        return
+
+    digest_id, events = item
+    text = f"📋 [운영 알림 요약 #{digest_id}] 전체 {len(events)}건\n\n" + "\n\n".join(d for _, _, d in events)
+    for chunk in _chunk_text(text):
+        await update.message.reply_text(chunk)
+
+# ─────────────────────────────
+# 주문/결제 기록 보관소 (일자별 파티션 + 보조 인덱스)
+# ─────────────────────────────
+ARCHIVE_FILE = BASE_DIR / "archive.db"
+ARCHIVE_COMPACT_DAYS = int(os.getenv("ARCHIVE_COMPACT_DAYS", "30") or "30")   # 이 기간이 지난 일자 파티션은 월 파티션으로 합침
+
+ARCHIVE_COLUMNS = (
+    "ts REAL NOT NULL, kind TEXT NOT NULL, uid TEXT, chat_id INTEGER, order_type TEXT, qty INTEGER, "
+    "amount TEXT, amount_micro INTEGER, txid TEXT, from_addr TEXT, target TEXT, created_at REAL, detail TEXT"
+)
+ARCHIVE_INDEXES = ("ts", "uid", "chat_id", "txid", "amount_micro", "target")
+
+# /history 검색 필드 → 컬럼
+ARCHIVE_FIELDS = {"uid": "uid", "chat": "chat_id", "txid": "txid", "amount": "amount_micro", "target": "target"}
+
+class OrderArchive:
+    """
+    완료/만료/미매칭 기록을 추가만 하는 보관소.
+    일자별 테이블(p_YYYYMMDD)에 쓰고, 오래된 일자 테이블은 월 테이블(m_YYYYMM)로 합친다.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = None
+        self.partitions: set[str] = set()
+
+    def _db(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS consumer_offsets (name TEXT PRIMARY KEY, seq INTEGER NOT NULL)")
+            rows = self.conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
+            self.partitions = {r[0] for r in rows if r[0][:2] in ("p_", "m_")}
+        return self.conn
+
+    def _ensure(self, name: str):
+        if name in self.partitions:
+            return
+        db = self._db()
+        db.execute(f"CREATE TABLE IF NOT EXISTS {name} ({ARCHIVE_COLUMNS})")
+        for col in ARCHIVE_INDEXES:
+            db.execute(f"CREATE INDEX IF NOT EXISTS {name}_{col} ON {name} ({col})")
+        self.partitions.add(name)
+
+    @staticmethod
+    def _day(ts: float) -> str:
+        return "p_" + datetime.utcfromtimestamp(ts).strftime("%Y%m%d")
+
+    def append_many(self, records: list[dict], offset: int | None = None):
+        """offset을 주면 같은 트랜잭션에서 아웃박스 소비 위치도 기록 (중복 기록 방지)"""
+        with self.lock:
+            db = self._db()
+            with db:
+                for r in records:
+                    name = self._day(r["ts"])
+                    self._ensure(name)
+                    amount = r.get("amount")
+                    db.execute(
+                        f"INSERT INTO {name} VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                        (
+                            r["ts"], r["kind"], r.get("uid"), r.get("chat_id"), r.get("order_type"), r.get("qty"),
+                            str(amount) if amount is not None else None,
+                            int(Decimal(amount) * 1_000_000) if amount is not None else None,
+                            r.get("txid"), r.get("from_addr"), r.get("target"), r.get("created_at"),
+                            json.dumps(r.get("detail") or {}, ensure_ascii=False),
+                        ),
+                    )
+                if offset is not None:
+                    db.execute("INSERT OR REPLACE INTO consumer_offsets VALUES ('outbox', ?)", (offset,))
+
+    def outbox_offset(self) -> int:
+        with self.lock:
+            row = self._db().execute("SELECT seq FROM consumer_offsets WHERE name = 'outbox'").fetchone()
+        return row[0] if row else 0
+
+    def _tables(self, t0=None, t1=None):
+        """기간에 걸치는 파티션을 (담을 수 있는 가장 늦은 일자, 이름) 으로 늦은 순 반환"""
+        self._db()
+        d0 = datetime.utcfromtimestamp(t0).strftime("%Y%m%d") if t0 else "00000000"
+        d1 = datetime.utcfromtimestamp(t1).strftime("%Y%m%d") if t1 else "99999999"
+        out = []
+        for name in self.partitions:
+            key = name[2:]
+            lo, hi = (key + "01", key + "31") if name.startswith("m_") else (key, key)
+            if hi >= d0 and lo <= d1:
+                out.append((hi, name))
+        return sorted(out, reverse=True)
+
+    def query(self, field: str, lo=None, hi=None, t0=None, t1=None, limit: int = 20) -> list[dict]:
+        """
+        field: uid / chat_id / txid / amount_micro / target / None(기간 조회).
+        lo만 주면 일치 검색, hi까지 주면 범위 검색(lo <= x <= hi). target은 접두어 검색.
+        """
+        where, args = [], []
+        if field == "target":
+            where.append("target >= ? AND target < ?")
+            args += [lo, lo + "\uffff"]
+        elif field and hi is not None:
+            where.append(f"{field} BETWEEN ? AND ?")
+            args += [lo, hi]
+        elif field:
+            where.append(f"{field} = ?")
+            args.append(lo)
+        if t0 is not None:
+            where.append("ts >= ?")
+            args.append(t0)
+        if t1 is not None:
+            where.append("ts < ?")
+            args.append(t1)
+        cond = " AND ".join(where) or "1"
+
+        rows = []
+        with self.lock:
+            db = self._db()
+            for hi, name in self._tables(t0, t1):
+                # 월 파티션은 같은 달의 일자 파티션과 기간이 겹치므로 합쳐서 ts 순으로 자름.
+                # 이미 limit건을 모았고 이 파티션의 가장 늦은 일자가 limit번째 행보다 이르면 더 볼 필요 없음
+                if len(rows) >= limit and hi < datetime.utcfromtimestamp(rows[-1]["ts"]).strftime("%Y%m%d"):
+                    break
+                cur = db.execute(
+                    f"SELECT ts, kind, uid, chat_id, order_type, qty, amount, txid, from_addr, target, created_at, detail "
+                    f"FROM {name} WHERE {cond} ORDER BY ts DESC LIMIT ?",
+                    (*args, limit),
+                )
+                keys = [c[0] for c in cur.description]
+                rows += [dict(zip(keys, r)) for r in cur.fetchall()]
+                rows.sort(key=lambda r: r["ts"], reverse=True)
+                del rows[limit:]
+        return rows
+
+    def compact(self, now: float) -> int:
+        """ARCHIVE_COMPACT_DAYS 보다 오래된 일자 파티션을 월 파티션으로 합침"""
+        cutoff = datetime.utcfromtimestamp(now - ARCHIVE_COMPACT_DAYS * 86400).strftime("%Y%m%d")
+        merged = 0
+        with self.lock:
+            db = self._db()
+            for name in sorted(self.partitions):
+                if not name.startswith("p_") or name[2:] >= cutoff:
                     continue
+                month = "m_" + name[2:8]
+                self._ensure(month)
+                with db:
+                    db.execute(f"INSERT INTO {month} SELECT * FROM {name}")
+                    db.execute(f"DROP TABLE {name}")
+                self.partitions.discard(name)
+                merged += 1
+            if merged:
+                db.execute("VACUUM")
+        return merged
+
+order_archive = OrderArchive(ARCHIVE_FILE)
+
+def _order_target(order: dict) -> str:
+    if order.get("items"):
+        return "\n".join(_bulk_item_line(i, item) for i, item in enumerate(order["items"], 1))
+    links = order.get("views_links") or order.get("reacts_links")
+    if links:
+        return "\n".join(links)
+    return order.get("target") or order.get("target_telf") or ""
+
+def _order_records(kind: str, uid: str, order: dict, ts: float, txids=(None,), detail=None, **extra) -> list[dict]:
+    # 배정된 수신 주소는 detail에 함께 남김 (replay.py 가 실시간과 같은 주소 필터로 재매칭)
+    detail = {"pay_address": order.get("pay_address"), **(detail or {})}
+    return [
+        {
+            "ts": ts, "kind": kind, "uid": uid, "chat_id": order.get("chat_id"),
+            "order_type": order.get("type", "ghost"), "qty": order.get("qty"), "amount": order.get("amount"),
+            "txid": txid, "target": _order_target(order), "created_at": order.get("created_at"),
+            "detail": detail, **extra,
+        }
+        for txid in txids
+    ]
 
-                log.debug("[FETCH] txs=%s", len(txs))
-                all_txids = [t.get("transaction_id") or t.get("hash") or t.get("transactionHash") for t in txs]
-                log.debug("[FETCH_TXIDS] %s", all_txids)
+async def _compact_archive(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        merged = await asyncio.to_thread(order_archive.compact, time.time())
+        if merged:
+            log.info("[ARCHIVE] compacted partitions=%s", merged)
+    except Exception as e:
+        log.error("[ARCHIVE_COMPACT_ERROR] %s", e)
+
+def _fmt_archive_row(r: dict) -> str:
+    when = datetime.utcfromtimestamp(r["ts"]).strftime("%m-%d %H:%M")
+    line = f"{when} | {r['kind']} | {r['order_type'] or '-'} {r['qty'] or ''} | {r['amount'] or '-'} USDT"
+    if r["uid"]:
+        line += f" | uid {r['uid']}"
+    if r["txid"]:
+        line += f"\n   TX {r['txid']}"
+    if r["target"]:
+        line += f"\n   → {r['target'].splitlines()[0]}"
+    return line
+
+HISTORY_USAGE = (
+    "사용법:\n"
+    "/history uid <유저ID>\n"
+    "/history chat <채팅ID>\n"
+    "/history txid <TXID>\n"
+    "/history amount <금액> [최대금액]\n"
+    "/history target <주소/링크 앞부분>\n"
+    "/history date <YYYY-MM-DD> [YYYY-MM-DD]"
+)
 
-                for tx in txs:
-                    ts = tx.get("block_timestamp") or tx.get("timestamp") or 0
-                    txid = tx.get("transaction_id") or tx.get("hash") or tx.get("transactionHash")
+async def history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not _is_admin(update):
+        return
+    args = context.args or []
+    if len(args) < 2:
+        await update.message.reply_text(HISTORY_USAGE)
+        return
 
-                    # 중복 방지
-                    if not txid or txid in processed_txs or txid in seen_txids:
-                        continue
-                    if ts < last_seen_ts:
-                        continue
+    field, value = args[0].lower(), args[1]
+    lo = hi = t0 = t1 = None
+    column = ARCHIVE_FIELDS.get(field)
+    try:
+        if field == "date":
+            start = datetime.strptime(value, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+            end = datetime.strptime(args[2], "%Y-%m-%d").replace(tzinfo=timezone.utc) if len(args) > 2 else start
+            t0, t1 = start.timestamp(), (end + timedelta(days=1)).timestamp()
+        elif field == "amount":
+            # 금액 1개면 소수 둘째 자리 기준 일치, 2개면 범위
+            a = Decimal(value)
+            b = Decimal(args[2]) if len(args) > 2 else a
+            lo = int((a - Decimal("0.005")) * 1_000_000) if len(args) == 2 else int(a * 1_000_000)
+            hi = int((b + Decimal("0.005")) * 1_000_000) if len(args) == 2 else int(b * 1_000_000)
+        elif column:
+            lo = int(value) if field == "chat" else value
+        else:
+            await update.message.reply_text(HISTORY_USAGE)
+            return
+    except (ValueError, InvalidOperation):
+        await update.message.reply_text(HISTORY_USAGE)
+        return
 
-                    last_seen_ts = max(last_seen_ts, ts)
-                    _save_state()
-                    seen_txids.add(txid)
+    rows = await asyncio.to_thread(order_archive.query, column, lo, hi, t0, t1)
+    if not rows:
+        await update.message.reply_text("검색 결과가 없습니다.")
+        return
+    text = f"🗂 [기록 검색] {' '.join(args)} — {len(rows)}건\n\n" + "\n".join(_fmt_archive_row(r) for r in rows)
+    for chunk in _chunk_text(text):
+        await update.message.reply_text(chunk)
+
+# ─────────────────────────────
+# 실시간 판매 통계 (고정 버킷 롤링 집계)
+# ─────────────────────────────
+STATS_FILE = BASE_DIR / "stats.json"
+STATS_CHECKPOINT = int(os.getenv("STATS_CHECKPOINT", "60") or "60")   # 통계 저장 주기(초)
+TTP_BIN = 30            # 결제까지 걸린 시간 히스토그램 칸 너비(초)
+TTP_BINS = ORDER_TTL // TTP_BIN + 1
+
+STATS_WINDOWS = {"1h": (3600, 60), "24h": (86400, 96), "7d": (7 * 86400, 168)}   # 이름: (기간, 버킷 수)
+STATS_WINDOW_LABELS = {"1h": "1시간", "24h": "24시간", "7d": "7일"}
+
+class RollingWindow:
+    """기간을 고정 개수 버킷으로 나눈 링 버퍼. 기록/조회 비용이 누적 이력과 무관"""
+    __slots__ = ("width", "slots")
+
+    def __init__(self, span: int, buckets: int):
+        self.width = span / buckets
+        self.slots: list = [None] * buckets   # [버킷 번호, {키: 값}]
+
+    def bucket(self, now: float) -> dict:
+        idx = int(now // self.width)
+        pos = idx % len(self.slots)
+        slot = self.slots[pos]
+        if slot is not None and slot[0] > idx:
+            return {}   # 이미 지나간 버킷 (시계 역행) → 버림
+        if slot is None or slot[0] != idx:
+            slot = self.slots[pos] = [idx, {}]
+        return slot[1]
+
+    def totals(self, now: float) -> dict:
+        oldest = int(now // self.width) - len(self.slots)
+        out: dict = {}
+        for slot in self.slots:
+            if slot is not None and slot[0] > oldest:
+                for k, v in slot[1].items():
+                    out[k] = out.get(k, 0) + v
+        return out
+
+class RollingStats:
+    def __init__(self):
+        self.windows = {name: RollingWindow(span, n) for name, (span, n) in STATS_WINDOWS.items()}
+
+    def add(self, key: str, value=1, now: float | None = None):
+        now = time.time() if now is None else now
+        for w in self.windows.values():
+            b = w.bucket(now)
+            b[key] = b.get(key, 0) + value
+
+    def totals(self, name: str) -> dict:
+        return self.windows[name].totals(time.time())
+
+    def dump(self) -> dict:
+        return {
+            name: [[s[0], {k: str(v) for k, v in s[1].items()}] for s in w.slots if s is not None]
+            for name, w in self.windows.items()
+        }
 
-                    log.debug("[RAW_TX] %s", json.dumps(tx, ensure_ascii=False))
+    def restore(self, data: dict):
+        for name, slots in data.items():
+            w = self.windows.get(name)
+            if w is None:
+                continue
+            for idx, values in slots:
+                w.slots[idx % len(w.slots)] = [idx, {k: int(v) if v.lstrip("-").isdigit() else Decimal(v) for k, v in values.items()}]
+
+sales_stats = RollingStats()
+
+def _order_kinds(order: dict) -> list[str]:
+    if order.get("items"):
+        return [it["type"] for it in order["items"]]
+    return [order.get("type", "ghost")]
+
+def _stats_order(event: str, order: dict):
+    """event = created / paid / expired"""
+    for kind in _order_kinds(order):
+        sales_stats.add(f"{event}:{kind}")
+    sales_stats.add(f"{event}:orders")
+    if event == "paid":
+        sales_stats.add("revenue", order["amount"])
+        waited = max(0.0, time.time() - order.get("created_at", 0))
+        sales_stats.add(f"ttp:{min(int(waited // TTP_BIN), TTP_BINS - 1)}")
+
+def _stats_unmatched(amount: Decimal):
+    sales_stats.add("unmatched")
+    sales_stats.add("unmatched_amount", amount)
+
+def _median_ttp(totals: dict):
+    counts = [totals.get(f"ttp:{i}", 0) for i in range(TTP_BINS)]
+    total = sum(counts)
+    if not total:
+        return None
+    seen = 0
+    for i, n in enumerate(counts):
+        seen += n
+        if seen * 2 >= total:
+            return (i + 0.5) * TTP_BIN
+    return None
+
+def _save_stats():
+    try:
+        tmp = STATS_FILE.with_suffix(".tmp")
+        tmp.write_text(json.dumps(sales_stats.dump()), encoding="utf-8")
+        os.replace(tmp, STATS_FILE)
+    except Exception as e:
+        log.error("[STATS_SAVE_ERROR] %s", e)
 
-                    try:
-                        to_addr = (tx.get("to_address") or tx.get("to") or tx.get("toAddress") or "").strip()
-                        from_addr = (tx.get("from_address") or tx.get("from") or tx.get("fromAddress") or "").strip()
+def _load_stats():
+    if not STATS_FILE.exists():
+        return
+    try:
+        sales_stats.restore(json.loads(STATS_FILE.read_text(encoding="utf-8")))
+        log.info("[STATS] loaded")
+    except Exception as e:
+        log.error("[STATS_LOAD_ERROR] %s", e)
 
-                        try:
-                            token_decimals = int(tx.get("tokenDecimal", 6))
-                        except Exception:
-                            token_decimals = 6
+async def _checkpoint_stats(context: ContextTypes.DEFAULT_TYPE):
+    _save_stats()
 
-                        raw = _extract_amount(tx)
-                        amount = _to_decimal_amount(raw, token_decimals)
-                        log.debug("[TX] id=%s to=%s raw=%s -> %s", txid, to_addr, raw, amount)
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not _is_admin(update):
+        return
+    lines = ["📊 판매 통계", f"- 현재 보류 주문: {len(pending_orders)}건"]
+    for name in STATS_WINDOWS:
+        t = sales_stats.totals(name)
+        created, paid = t.get("created:orders", 0), t.get("paid:orders", 0)
+        median = _median_ttp(t)
+        lines += [
+            "",
+            f"[{STATS_WINDOW_LABELS[name]}]",
+            f"- 주문: {created}건 / 결제: {paid}건 / 만료: {t.get('expired:orders', 0)}건"
+            + (f" / 전환율 {paid / created * 100:.1f}%" if created else ""),
+        ]
+        for k in ORDER_PRICES:
+            c, p = t.get(f"created:{k}", 0), t.get(f"paid:{k}", 0)
+            if c or p:
+                lines.append(
+                    f"  · {BULK_TYPE_LABELS[k]}: 주문 {c} / 결제 {p} / 만료 {t.get(f'expired:{k}', 0)}"
+                    + (f" / 전환율 {p / c * 100:.1f}%" if c else "")
+                )
+        lines += [
+            f"- 매출: {Decimal(t.get('revenue', 0)):.2f} USDT",
+            "- 결제까지 중앙값: " + (f"{int(median // 60)}분 {int(median % 60)}초" if median is not None else "-"),
+            f"- 미매칭 입금: {t.get('unmatched', 0)}건 / {Decimal(t.get('unmatched_amount', 0)):.2f} USDT",
+        ]
+    await update.message.reply_text("\n".join(lines))
+
+async def credits_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """송금 주소별 초과 입금 크레딧 조회. 같은 주소의 다음 주문 부족분에 자동 사용됨"""
+    if not _is_admin(update):
+        return
+    if not sender_credits:
+        await update.message.reply_text("💳 보유 크레딧이 없습니다.")
+        return
+    rows = sorted(sender_credits.items(), key=lambda kv: kv[1], reverse=True)
+    text = (f"💳 송금 주소별 크레딧 ({len(rows)}건 / 합계 {sum(v for _, v in rows)} USDT)\n"
+            + "".join(f"- {addr}: {amount} USDT\n" for addr, amount in rows))
+    for chunk in _chunk_text(text):
+        await update.message.reply_text(chunk)
 
-                        if amount is None:
-                            continue
+# ─────────────────────────────
+# 운영자 진단 명령 (/profile, /lag)
+# ─────────────────────────────
+async def profile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not _is_admin(update):
+        return
+    if profiler.running:
+        await update.message.reply_text("이미 프로파일링 중입니다.")
+        return
+    try:
+        seconds = min(PROFILE_MAX_SECONDS, max(1, int(context.args[0]))) if context.args else 10
+    except ValueError:
+        await update.message.reply_text(f"사용법: /profile [초, 최대 {PROFILE_MAX_SECONDS}]")
+        return
+
+    # 비차단 핸들러라 동시에 들어온 /profile 과 겹치지 않도록 바로 표시
+    profiler.running = True
+    try:
+        await update.message.reply_text(f"🔬 {seconds}초 동안 프로파일링합니다...")
+        loop_thread = threading.get_ident()   # 핸들러는 이벤트 루프 스레드에서 실행됨
+        stacks = await asyncio.to_thread(profiler.run, loop_thread, seconds)
+    finally:
+        profiler.running = False
+
+    path = PROFILE_DIR / f"profile-{datetime.utcnow():%Y%m%d-%H%M%S}.folded"
+    SamplingProfiler.dump(stacks, path)
+    text = SamplingProfiler.report(stacks) + "\n\n" + lag_monitor.report()
+    for chunk in _chunk_text(text):
+        await update.message.reply_text(chunk)
+    with path.open("rb") as f:
+        await update.message.reply_document(f, filename=path.name, caption="flamegraph용 collapsed stack")
+
+async def lag_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not _is_admin(update):
+        return
+    await update.message.reply_text(lag_monitor.report())
+
+# ─────────────────────────────
+# 결제 이벤트 아웃박스 (추가 전용 로그 + 소비자별 오프셋)
+# ─────────────────────────────
+OUTBOX_FILE = BASE_DIR / "outbox.jsonl"
+OUTBOX_OFFSETS_FILE = BASE_DIR / "outbox_offsets.json"
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5") or "5")   # 네트워크 외 오류 재시도 횟수 (넘으면 건너뜀)
+OUTBOX_MAX_BACKOFF = 60      # 재시도 대기 상한(초)
+OUTBOX_COMPACT_EVERY = 500   # 모든 소비자가 지나간 이벤트가 이만큼 쌓이면 로그 파일 재작성
+
+class PaymentOutbox:
+    """
+    결제 이벤트(paid / unmatched / expired)를 fsync 후 추가만 하는 로그.
+    이벤트 기록이 곧 커밋이고, 상태 파일에는 마지막으로 반영한 seq만 남겨 재시작 시 그 이후를 다시 반영한다.
+    소비자(고객 알림 / 운영자 알림 / 보관소)는 각자 오프셋을 갖고 결제 루프와 무관하게 따라간다.
+    """
+    def __init__(self, path: Path, offsets_path: Path, consumers: tuple):
+        self.path = path
+        self.offsets_path = offsets_path
+        self.consumers = consumers
+        self.events: list[dict] = []        # 아직 지워지지 않은 이벤트 (seq 오름차순, 연속)
+        self.seq = 0                        # 마지막으로 기록한 seq
+        self.applied = 0                    # 메모리 상태에 반영한 마지막 seq
+        self.checkpoint = 0                 # 상태 파일에 저장된 마지막 seq
+        self.offsets: dict[str, int] = {}
+        self.wakeups: dict[str, asyncio.Event] = {}
+        self.dropped = 0
+        self.fh = None
+
+    def load(self, archive_offset: int = 0):
+        if self.offsets_path.exists():
+            self.offsets = {k: int(v) for k, v in json.loads(self.offsets_path.read_text(encoding="utf-8")).items()}
+        # 보관소 오프셋은 기록과 같은 트랜잭션에 저장되므로 그쪽이 기준
+        self.offsets["archive"] = archive_offset
+        if self.path.exists():
+            for line in self.path.read_text(encoding="utf-8").splitlines():
+                try:
+                    self.events.append(json.loads(line))
+                except ValueError:
+                    continue   # 기록 도중 끊긴 마지막 줄
+        # 로그가 비어 있어도 seq가 되돌아가지 않도록 오프셋/체크포인트 중 최댓값부터 이어감
+        self.seq = max([self.applied, *self.offsets.values()] + [ev["seq"] for ev in self.events[-1:]])
+        self._rewrite()   # 끊긴 줄 정리 + 이미 소비된 이벤트 제거
+
+    def _rewrite(self):
+        low = self._low()
+        self.events = [ev for ev in self.events if ev["seq"] > low]
+        if self.fh is not None:
+            self.fh.close()
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(ev, ensure_ascii=False) + "\n" for ev in self.events)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.fh = open(self.path, "a", encoding="utf-8")
+        self.dropped = 0
+
+    def _low(self) -> int:
+        return min([self.offsets.get(name, 0) for name in self.consumers] + [self.checkpoint])
+
+    def append(self, kind: str, **payload) -> dict:
+        self.seq += 1
+        ev = {"seq": self.seq, "kind": kind, "ts": time.time(), **payload}
+        self.fh.write(json.dumps(ev, ensure_ascii=False) + "\n")
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+        self.events.append(ev)
+        for wake in self.wakeups.values():
+            wake.set()
+        return ev
+
+    def register(self, name: str) -> asyncio.Event:
+        self.offsets.setdefault(name, 0)
+        return self.wakeups.setdefault(name, asyncio.Event())
+
+    def pending(self, name: str) -> list[dict]:
+        if not self.events:
+            return []
+        return self.events[max(0, self.offsets.get(name, 0) + 1 - self.events[0]["seq"]):]
+
+    def ack(self, name: str, seq: int):
+        self.offsets[name] = seq
+        tmp = self.offsets_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.offsets), encoding="utf-8")
+        os.replace(tmp, self.offsets_path)
+        self.compact()
+
+    def compact(self):
+        low = self._low()
+        n = 0
+        while n < len(self.events) and self.events[n]["seq"] <= low:
+            n += 1
+        if n:
+            del self.events[:n]
+            self.dropped += n
+        if self.dropped >= OUTBOX_COMPACT_EVERY:
+            self._rewrite()
+
+OUTBOX_CONSUMERS = ("customer", "admin", "archive")
+payment_outbox = PaymentOutbox(OUTBOX_FILE, OUTBOX_OFFSETS_FILE, OUTBOX_CONSUMERS)
+
+ORDER_TYPE_LABELS = {
+    "ghost": "유령인원",
+    "telf": "텔프유령인원",
+    "views": "조회수",
+    "reacts": "게시글 반응",
+    "bulk": "대량 주문",
+}
+
+def _order_json(order: dict) -> dict:
+    return {**order, "amount": str(order["amount"])}
+
+def _event_order(ev: dict) -> dict:
+    order = ev["order"]
+    return {**order, "amount": Decimal(order["amount"])}
+
+def _apply_payment_event(ev: dict):
+    """이벤트에 해당하는 상태 변경 반영 (결제 루프 / 재시작 시 체크포인트 이후 재반영 공용)"""
+    kind = ev["kind"]
+    if kind == "paid":
+        used, credit = Decimal(ev.get("credit_used", "0")), Decimal(ev["credit"])
+        if used > 0:
+            _use_credit(ev["from_addr"], used)
+        if credit > AMOUNT_TOLERANCE:
+            _add_credit(ev["from_addr"], credit)
+        # 합산 매칭이면 원장 내역 정리 (실시간 경로는 매칭 시 이미 정리돼 있음)
+        if any(t in sender_ledger.txids for t in ev["txids"]):
+            sender_ledger.consume(ev["from_addr"])
+        processed_txs.update(ev["txids"])
+        pending_orders.pop(ev["uid"], None)
+    elif kind == "unmatched":
+        # 원장 반영은 매칭 시점에 이미 됐지만, 체크포인트 이후 재반영이면 이벤트 내용으로 다시 넣음
+        if ev.get("ledger_ts") is not None:
+            sender_ledger.add(ev["from_addr"], ev["ledger_ts"], Decimal(ev["amount"]), ev["txid"])
+        processed_txs.add(ev["txid"])
+    elif kind == "expired":
+        pending_orders.pop(ev["uid"], None)
+    payment_outbox.applied = ev["seq"]
+
+def _replay_outbox():
+    payment_outbox.load(order_archive.outbox_offset())
+    replayed = [ev for ev in payment_outbox.events if ev["seq"] > payment_outbox.applied]
+    for ev in replayed:
+        _apply_payment_event(ev)
+    if replayed:
+        log.info("[OUTBOX] replayed %s events (seq %s~%s)", len(replayed), replayed[0]["seq"], replayed[-1]["seq"])
+        _save_state()
 
-                        # ── 매칭 체크 내부 ──
-                        for uid, order in list(pending_orders.items()):
-                            expected = order["amount"].quantize(Decimal("0.01"))
-                            actual = amount.quantize(Decimal("0.01"))
-
-                            if abs(expected - actual) <= AMOUNT_TOLERANCE:
-                                matched_uid = uid
-                                chat_id = order["chat_id"]
-                                order_type = order.get("type", "ghost")  # ✅ 추가
-                                log.info("[MATCH_SUCCESS] uid=%s txid=%s 금액=%s", uid, txid, actual)
-
-                                # 👉 고객 알림 수량 텍스트
-                                if order_type == "views":
-                                    post_count = len(order.get("views_links", []))
-                                    per_post = order['qty'] // post_count if post_count else order['qty']
-                                    qty_text = f"{per_post:,} × {post_count}개 게시글 = {order['qty']:,}회"
-
-                                elif order_type == "reacts":
-                                    post_count = len(order.get("reacts_links", []))
-                                    per_post = order['qty'] // post_count if post_count else order['qty']
-                                    qty_text = f"{per_post:,} × {post_count}개 게시글 = {order['qty']:,}개"
-
-                                else:
-                                    qty_text = f"{order['qty']:,}명"
-
-                                # 고객 알림 전송
-                                await app.bot.send_message(
-                                    chat_id=chat_id,
-                                    text=(f"✅ 결제가 확인되었습니다!\n"
-                                          f"- 금액: {order['amount']:.2f} USDT\n"
-                                          f"- 주문 수량: {qty_text}\n\n"
-                                          "15분 내로 인원이 들어갑니다.")
-                                )
-
-                                # 👉 운영자 알림 준비
-                                type_label = {
-                                    "ghost": "유령인원",
-                                    "telf": "텔프유령인원",
-                                    "views": "조회수",
-                                    "reacts": "게시글 반응"
-                                }.get(order_type, "알 수 없음")
-
-                                try:
-                                    user = await app.bot.get_chat(chat_id)
-                                    username = f"@{user.username}" if user.username else f"ID:{matched_uid}"
-                                except Exception:
-                                    username = f"ID:{matched_uid}"
-
-                                # 종류별 주소/링크 처리
-                                if order_type in ["ghost", "telf"]:
-                                    addr = order.get("target") or order.get("target_telf") or "❌ 주소 미입력"
-                                    qty_text = f"{order['qty']:,}명"
-
-                                elif order_type == "views":
-                                    links = order.get("views_links", [])
-                                    count = len(links)
-                                    per_post = order['qty'] // count if count else order['qty']
-                                    addr = "\n".join([f"{i+1}. {l}" for i, l in enumerate(links, 1)]) or "❌ 링크 미입력"
-                                    qty_text = f"{per_post:,} × {count}개 게시글 = {order['qty']:,}회"
-
-                                elif order_type == "reacts":
-                                    links = order.get("reacts_links", [])
-                                    count = len(links)
-                                    per_post = order['qty'] // count if count else order['qty']
-                                    addr = "\n".join([f"{i+1}. {l}" for i, l in enumerate(links, 1)]) or "❌ 링크 미입력"
-                                    qty_text = f"{per_post:,} × {count}개 게시글 = {order['qty']:,}개"
-
-                                else:
-                                    addr = "❌ 주소/링크 미입력"
-
-                                # 운영자 알림 전송
-                                await app.bot.send_message(
-                                    chat_id=ADMIN_CHAT_ID,
-                                    text=(f"🟢 [결제 확인]\n"
-                                          f"- 주문자: {username}\n"
-                                          f"- 종류: {type_label}\n"
-                                          f"- 수량: {qty_text}\n"
-                                          f"- 주소/링크:\n{addr}\n"
-                                          f"- 금액: {order['amount']} USDT\n"
-                                          f"- TXID: <code>{txid}</code>"),
-                                    parse_mode="HTML"
-                                )
-
-                                processed_txs.add(txid)
-                                pending_orders.pop(matched_uid)
-                                _save_state()
-                                break
+def _qty_text(order: dict) -> str:
+    order_type = order.get("type", "ghost")
+    if order_type in ("views", "reacts"):
+        links = order.get(f"{order_type}_links", [])
+        post_count = len(links)
+        per_post = order['qty'] // post_count if post_count else order['qty']
+        unit = "회" if order_type == "views" else "개"
+        return f"{per_post:,} × {post_count}개 게시글 = {order['qty']:,}{unit}"
+    if order_type == "bulk":
+        return f"{len(order.get('items', []))}건 일괄 주문"
+    return f"{order['qty']:,}명"
+
+def _order_addr_text(order: dict) -> str:
+    order_type = order.get("type", "ghost")
+    if order_type in ("ghost", "telf"):
+        return order.get("target") or order.get("target_telf") or "❌ 주소 미입력"
+    if order_type in ("views", "reacts"):
+        links = order.get(f"{order_type}_links", [])
+        return "\n".join([f"{i+1}. {l}" for i, l in enumerate(links, 1)]) or "❌ 링크 미입력"
+    if order_type == "bulk":
+        return "\n".join(_bulk_item_line(i, item) for i, item in enumerate(order.get("items", []), 1))
+    return "❌ 주소/링크 미입력"
+
+async def _username(app, chat_id, uid) -> str:
+    try:
+        user = await app.bot.get_chat(chat_id)
+        return f"@{user.username}" if user.username else f"ID:{uid}"
+    except Exception:
+        return f"ID:{uid}"
+
+async def _deliver_customer(app, ev: dict):
+    if ev["kind"] == "paid":
+        order = _event_order(ev)
+        await app.bot.send_message(
+            chat_id=order["chat_id"],
+            text=(f"✅ 결제가 확인되었습니다!\n"
+                  f"- 금액: {order['amount']:.2f} USDT\n"
+                  f"- 주문 수량: {_qty_text(order)}\n\n"
+                  "15분 내로 인원이 들어갑니다.")
+        )
+    elif ev["kind"] == "expired":
+        await app.bot.send_message(
+            chat_id=ev["order"]["chat_id"],
+            text="⏰ 결제 제한시간(15분)이 초과되어 주문이 자동 취소되었습니다.\n"
+                 "다시 주문을 진행해주세요."
+        )
+
+async def _deliver_admin(app, ev: dict):
+    if not ADMIN_CHAT_ID:
+        return
+    kind = ev["kind"]
+    if kind == "paid":
+        order = _event_order(ev)
+        txids, paid, credit = ev["txids"], Decimal(ev["paid"]), Decimal(ev["credit"])
+        used = Decimal(ev.get("credit_used", "0"))
+        username = await _username(app, order["chat_id"], ev["uid"])
+        bulk = order.get("type") == "bulk"
+        if bulk:
+            # 항목이 많으면 메시지 길이 제한을 넘으므로 요약을 먼저, 항목 목록은 끝에 붙여 나눠 전송
+            where = f"- 배치: {html.escape(ev['uid'])} ({len(order.get('items', []))}건, 항목 목록은 아래)\n"
+            if order.get("reference"):
+                where += f"- 참조: {html.escape(order['reference'])}\n"
+        else:
+            where = f"- 주소/링크:\n{html.escape(_order_addr_text(order))}\n"
+        text = (f"🟢 [결제 확인]\n"
+                f"- 주문자: {html.escape(username)}\n"
+                f"- 종류: {ORDER_TYPE_LABELS.get(order.get('type', 'ghost'), '알 수 없음')}\n"
+                f"- 수량: {_qty_text(order)}\n"
+                + where
+                + f"- 금액: {order['amount']} USDT\n"
+                + (f"- 수신: {ev['to_addr']} ({ev['token']})\n" if len(PAYMENT_STREAMS) > 1 else "")
+                + (f"- 입금 합계: {paid} USDT ({len(txids)}건 합산)\n" if len(txids) > 1 else "")
+                + (f"- 크레딧 사용: {used} USDT\n" if used > 0 else "")
+                + (f"- 초과 입금(크레딧): {credit} USDT\n" if credit > AMOUNT_TOLERANCE else "")
+                + "".join(f"- TXID: <code>{t}</code>\n" for t in txids))
+        if bulk:
+            text += "\n📦 항목 목록\n" + html.escape(_order_addr_text(order))
+        for chunk in _chunk_text(text):
+            await app.bot.send_message(chat_id=ADMIN_CHAT_ID, text=chunk, parse_mode="HTML")
+
+    elif kind == "unmatched":
+        amount = Decimal(ev["amount"])
+        urgent = amount >= ADMIN_URGENT_AMOUNT
+        summary = f"{amount:.6f} USDT from {ev['from_addr'][:8]}… TX {ev['txid'][:10]}…"
+        if ev["pending"]:
+            await notify_admin(
+                app.bot, "unmatched", summary,
+                f"⚠️ [미매칭 결제 감지]\n"
+                f"- TXID: {ev['txid']}\n"
+                f"- From: {ev['from_addr']}\n"
+                f"- To: {ev['to_addr']}\n"
+                f"- 금액: {amount:.6f} USDT ({ev['token']})\n"
+                f"- 송금 주소 누적: {ev['ledger_total']} USDT\n"
+                f"- 현재 보류 주문 수: {ev['pending']}개",
+                urgent=urgent,
+            )
+        else:
+            # 주문이 전혀 없는 상태에서 결제 들어옴
+            await notify_admin(
+                app.bot, "no_order", summary,
+                f"⚠️ [주문 없는 결제 감지]\n"
+                f"- TXID: {ev['txid']}\n"
+                f"- From: {ev['from_addr']}\n"
+                f"- To: {ev['to_addr']}\n"
+                f"- 금액: {amount:.6f} USDT\n"
+                "👉 주문 데이터가 없어 자동 처리 불가합니다.",
+                urgent=urgent,
+            )
+
+    elif kind == "expired":
+        order = _event_order(ev)
+        username = await _username(app, order["chat_id"], ev["uid"])
+        await notify_admin(
+            app.bot, "expired",
+            f"{username} {order['qty']:,} / {order['amount']} USDT",
+            f"❌ [주문 취소됨 - 시간초과]\n"
+            f"- 주문자: {username}\n"
+            f"- UID: {ev['uid']}\n"
+            f"- 수량: {order['qty']:,}\n"
+            f"- 금액: {order['amount']} USDT"
+        )
+
+async def _deliver_archive(app, ev: dict):
+    kind, ts = ev["kind"], ev["ts"]
+    if kind == "paid":
+        records = _order_records(
+            "paid", ev["uid"], _event_order(ev), ts, ev["txids"], from_addr=ev["from_addr"],
+            detail={"paid": ev["paid"], "txids": ev["txids"]},
+        )
+    elif kind == "expired":
+        records = _order_records("expired", ev["uid"], _event_order(ev), ts)
+    else:
+        records = [{
+            "ts": ts, "kind": "unmatched", "amount": ev["amount"],
+            "txid": ev["txid"], "from_addr": ev["from_addr"], "detail": {"to": ev["to_addr"]},
+        }]
+    await asyncio.to_thread(order_archive.append_many, records, ev["seq"])
+
+OUTBOX_HANDLERS = {
+    "customer": _deliver_customer,
+    "admin": _deliver_admin,
+    "archive": _deliver_archive,
+}
+
+async def _alert_skipped(app, name: str, ev: dict, err):
+    """결제 완료 이벤트를 끝내 전달하지 못하면 운영자에게 즉시 알림 (주문 처리 누락 방지)"""
+    if ev["kind"] != "paid" or not ADMIN_CHAT_ID:
+        return
+    order = ev["order"]
+    try:
+        await app.bot.send_message(
+            ADMIN_CHAT_ID,
+            f"🚨 [결제 알림 전달 실패 - 수동 확인 필요]\n"
+            f"- 대상: {name}\n"
+            f"- UID: {ev['uid']} (chat {order.get('chat_id')})\n"
+            f"- 금액: {order['amount']} USDT\n"
+            f"- TXID: {', '.join(ev['txids'])}\n"
+            f"- 오류: {err}",
+        )
+    except Exception as e:
+        log.error("[OUTBOX_ALERT_ERROR] consumer=%s seq=%s err=%s", name, ev["seq"], e)
+
+async def _deliver_event(app, name: str, handler, ev: dict):
+    """
+    이벤트 1건 전달. 네트워크 오류/RetryAfter 는 성공할 때까지 재시도(대기 상한 OUTBOX_MAX_BACKOFF),
+    차단/잘못된 요청은 즉시, 그 밖의 오류는 OUTBOX_MAX_ATTEMPTS 회 뒤 건너뜀
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            await handler(app, ev)
+            return
+        except (Forbidden, BadRequest) as e:
+            # 차단/잘못된 채팅 등 재시도해도 안 되는 오류 (BadRequest는 NetworkError 하위라 먼저 처리)
+            log.error("[OUTBOX_DROP] consumer=%s seq=%s kind=%s err=%s", name, ev["seq"], ev["kind"], e)
+            await _alert_skipped(app, name, ev, e)
+            return
+        except RetryAfter as e:
+            wait = e.retry_after
+            wait = wait.total_seconds() if hasattr(wait, "total_seconds") else float(wait)
+            log.warning("[OUTBOX_FLOOD] consumer=%s seq=%s retry_after=%ss", name, ev["seq"], wait)
+            await asyncio.sleep(wait)
+        except NetworkError as e:
+            # TimedOut 포함, 텔레그램 장애는 복구될 때까지 대기
+            log.warning("[OUTBOX_RETRY] consumer=%s seq=%s attempt=%s err=%s", name, ev["seq"], attempt, e)
+            await asyncio.sleep(min(OUTBOX_MAX_BACKOFF, 2 ** min(attempt, 10)))
+        except Exception as e:
+            if attempt >= OUTBOX_MAX_ATTEMPTS:
+                log.error("[OUTBOX_GIVEUP] consumer=%s seq=%s kind=%s err=%s", name, ev["seq"], ev["kind"], e)
+                await _alert_skipped(app, name, ev, e)
+                return
+            log.warning("[OUTBOX_RETRY] consumer=%s seq=%s attempt=%s err=%s", name, ev["seq"], attempt, e)
+            await asyncio.sleep(min(OUTBOX_MAX_BACKOFF, 2 ** attempt))
+
+async def _run_outbox_consumer(app, name: str):
+    """오프셋 이후 이벤트를 순서대로 전달. 전달(또는 포기) 후에만 오프셋 전진"""
+    handler = OUTBOX_HANDLERS[name]
+    wake = payment_outbox.register(name)
+    while True:
+        wake.clear()
+        for ev in payment_outbox.pending(name):
+            await _deliver_event(app, name, handler, ev)
+            payment_outbox.ack(name, ev["seq"])
+        await wake.wait()
+
+# ─────────────────────────────
+# 결제 감지 & 매칭 루프
+# ─────────────────────────────
+seen_txids = set()   # 같은 타임스탬프라도 TXID 단위로 중복 처리 방지
+
+async def check_tron_payments(app):
+    await tron_client.start()
+    try:
+        while True:
+            try:
+                if INGEST_MODE == "node":
+                    # 풀노드 블록 직접 스캔
+                    before = node_scanner.cursor
+                    transfers = await node_scanner.poll()
+                    if node_scanner.cursor != before:
+                        _save_state()   # 최초 위치 / reorg 되감기 저장
+                else:
+                    # 스트림별 조회를 동시에 실행 (공용 클라이언트 / 속도 제한 공유)
+                    before = [st.last_seen_ts for st in PAYMENT_STREAMS]
+                    batches = await asyncio.gather(*(_poll_stream(st) for st in PAYMENT_STREAMS))
+                    transfers = sorted((t for batch in batches for t in batch), key=lambda t: t.ts)
+                    if [st.last_seen_ts for st in PAYMENT_STREAMS] != before:
+                        _save_state()   # 최초 실행 커서 초기화 저장
+
+                log.debug("[FETCH] mode=%s transfers=%s", INGEST_MODE, len(transfers))
+                log.debug("[FETCH_TXIDS] %s", [t.txid for t in transfers])
+
+                for t in transfers:
+                    txid, ts = t.txid, t.ts
+
+                    # 중복 방지 (스트림 간 포함)
+                    if txid in processed_txs or txid in seen_txids:
+                        continue
+                    seen_txids.add(txid)
+
+                    try:
+                        from_addr, to_addr, amount = t.from_addr, t.to_addr, t.amount
+                        log.debug("[TX] id=%s to=%s %s %s -> %s USDT", txid, to_addr, t.token_amount, t.symbol, amount)
+
+                        # ── 매칭 체크 내부 (단건 금액 → 송금 주소 합산) ──
+                        match = _match_transfer(
+                            pending_orders, sender_ledger, txid, from_addr, amount, ts, to_addr, sender_credits,
+                        )
+                        if match:
+                            matched_uid, order, txids, paid, used = match
+                            log.info("[MATCH_SUCCESS] uid=%s txids=%s 금액=%s", matched_uid, txids, paid)
+
+                            # 이벤트 기록 = 커밋. 알림/보관은 아웃박스 소비자가 따로 전달
+                            ev = payment_outbox.append(
+                                "paid", uid=matched_uid, order=_order_json(order), txids=txids,
+                                paid=str(paid), credit_used=str(used), credit=str(paid + used - order["amount"]),
+                                from_addr=from_addr, to_addr=to_addr, token=f"{t.token_amount} {t.symbol}",
+                            )
+                            _apply_payment_event(ev)
+                            _stats_order("paid", order)
+                            _save_state()
                         else:
                             # 매칭 실패 처리
                             if pending_orders:
                                 log.warning("[MATCH_FAIL] txid=%s 금액=%s → 매칭 실패", txid, amount)
-                                if ADMIN_CHAT_ID:
-                                    await app.bot.send_message(
-                                        ADMIN_CHAT_ID,
-                                        f"⚠️ [미매칭 결제 감지]\n"
-                                        f"- TXID: {txid}\n"
-                                        f"- From: {from_addr}\n"
-                                        f"- To: {to_addr}\n"
-                                        f"- 금액: {amount:.6f} USDT\n"
-                                        f"- 현재 보류 주문 수: {len(pending_orders)}개"
-                                    )
                             else:
-                                # 주문이 전혀 없는 상태에서 결제 들어옴
                                 log.warning("[NO_ORDER_PAYMENT] txid=%s 금액=%s", txid, amount)
-                                if ADMIN_CHAT_ID:
-                                    await app.bot.send_message(
-                                        ADMIN_CHAT_ID,
-                                        f"⚠️ [주문 없는 결제 감지]\n"
-                                        f"- TXID: {txid}\n"
-                                        f"- From: {from_addr}\n"
-                                        f"- To: {to_addr}\n"
-                                        f"- 금액: {amount:.6f} USDT\n"
-                                        "👉 주문 데이터가 없어 자동 처리 불가합니다."
-                                    )
-                            processed_txs.add(txid)
+                            ev = payment_outbox.append(
+                                "unmatched", txid=txid, amount=str(amount), from_addr=from_addr, to_addr=to_addr,
+                                token=f"{t.token_amount} {t.symbol}", ledger_total=str(sender_ledger.total(from_addr)),
+                                ledger_ts=_ts_seconds(ts) if from_addr else None, pending=len(pending_orders),
+                            )
+                            _apply_payment_event(ev)
+                            _stats_unmatched(amount)
                             _save_state()
 
                     except Exception as e:
                         log.error("[ERROR] tx parse failed: %s", e)
                         continue
 
+                # 배치의 입금이 모두 아웃박스에 기록된 뒤에만 커서 전진 (중간에 죽으면 재시작 후 다시 조회)
+                if INGEST_MODE == "node":
+                    cursor_moved = node_scanner.commit()
+                else:
+                    cursor_moved = _advance_stream_cursors(transfers)
+                if cursor_moved:
+                    _save_state()
+
                 # ── 주문 만료(15분 초과) 체크 ──
-                now = datetime.utcnow().timestamp()
+                now = time.time()
                 expired = []
                 for uid, order in list(pending_orders.items()):
-                    if now - order.get("created_at", now) > 900:  # 900초 = 15분
+                    if now - order.get("created_at", now) > ORDER_TTL:
                         expired.append((uid, order))
 
                 for uid, order in expired:
-                    chat_id = order["chat_id"]
-                    try:
-                        # 고객 알림
-                        await app.bot.send_message(
-                            chat_id=chat_id,
-                            text="⏰ 결제 제한시간(15분)이 초과되어 주문이 자동 취소되었습니다.\n"
-                                 "다시 주문을 진행해주세요."
-                        )
-                        # 운영자 알림
-                        try:
-                            user = await app.bot.get_chat(chat_id)
-                            username = f"@{user.username}" if user.username else f"ID:{uid}"
-                        except Exception:
-                            username = f"ID:{uid}"
-
-                        await app.bot.send_message(
-                            ADMIN_CHAT_ID,
-                            f"❌ [주문 취소됨 - 시간초과]\n"
-                            f"- 주문자: {username}\n"
-                            f"- UID: {uid}\n"
-                            f"- 수량: {order['qty']:,}\n"
-                            f"- 금액: {order['amount']} USDT"
-                        )
-
-                    except Exception as e:
-                        log.error("[EXPIRE_NOTIFY_ERROR] uid=%s err=%s", uid, e)
-
-                    pending_orders.pop(uid, None)
+                    ev = payment_outbox.append("expired", uid=uid, order=_order_json(order))
+                    _apply_payment_event(ev)
+                    _stats_order("expired", order)
                     _save_state()
 
             except Exception as e:
                 log.error("[ERROR] tron payment check failed: %s", e)
 
             await asyncio.sleep(5)
+    finally:
+        await tron_client.close()
+
+# ─────────────────────────────────────────────
+# 대량 주문 API (리셀러용, 로컬 HTTP/JSON)
+# ─────────────────────────────────────────────
+BULK_API_HOST = os.getenv("BULK_API_HOST", "127.0.0.1")
+BULK_API_PORT = int(os.getenv("BULK_API_PORT", "0") or "0")     # 0이면 API 비활성
+BULK_API_TOKEN = (os.getenv("BULK_API_TOKEN") or "").strip()
+BULK_MAX_ORDERS = int(os.getenv("BULK_MAX_ORDERS", "500") or "500")
+
+BULK_TYPE_LABELS = {"ghost": "유령인원", "telf": "텔프유령인원", "views": "조회수", "reacts": "게시글 반응"}
+
+def _bulk_item_line(i: int, item: dict) -> str:
+    where = item.get("target") or ", ".join(item.get("links") or [])
+    return f"{i}. {BULK_TYPE_LABELS.get(item['type'], item['type'])} {item['qty']:,} → {where}"
+
+def _validate_bulk_item(raw) -> tuple[dict | None, str | None]:
+    """채팅 주문과 같은 규칙으로 검증 + 금액 계산. (item, None) 또는 (None, 오류)"""
+    if not isinstance(raw, dict):
+        return None, "주문 형식이 올바르지 않습니다."
+    kind = raw.get("type")
+    if kind not in ORDER_PRICES:
+        return None, f"지원하지 않는 종류입니다: {kind}"
+    qty = raw.get("qty")
+    if not isinstance(qty, int) or isinstance(qty, bool) or not _valid_qty(qty):
+        return None, "수량은 100단위 정수만 가능합니다."
+
+    item = {"type": kind, "qty": qty}
+    if kind in ("ghost", "telf"):
+        target = raw.get("target")
+        if not isinstance(target, str) or not target.strip():
+            return None, "target(그룹/채널 주소)이 필요합니다."
+        item["target"] = target.strip()
+        total_qty = qty
+    else:
+        links = raw.get("links")
+        if (not isinstance(links, list) or not 1 <= len(links) <= SESSION_MAX_LINKS
+                or not all(isinstance(l, str) and l.strip() for l in links)):
+            return None, f"links(게시글 링크)는 1~{SESSION_MAX_LINKS}개가 필요합니다."
+        item["links"] = [l.strip() for l in links]
+        total_qty = qty * len(links)
+
+    item["total_qty"] = total_qty
+    item["amount"] = str(_base_amount(ORDER_PRICES[kind], total_qty))
+    return item, None
+
+async def bulk_orders_api(request):
+    auth = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(auth.encode(), f"Bearer {BULK_API_TOKEN}".encode()):
+        return web.json_response({"error": "unauthorized"}, status=401)
+
+    try:
+        body = await request.json()
+    except Exception:
+        return web.json_response({"error": "invalid json"}, status=400)
+
+    raw_orders = body.get("orders") if isinstance(body, dict) else None
+    if not isinstance(raw_orders, list) or not 1 <= len(raw_orders) <= BULK_MAX_ORDERS:
+        return web.json_response({"error": f"orders는 1~{BULK_MAX_ORDERS}개의 목록이어야 합니다."}, status=400)
+    try:
+        chat_id = int(body.get("chat_id") or ADMIN_CHAT_ID)
+    except (TypeError, ValueError):
+        return web.json_response({"error": "chat_id가 올바르지 않습니다."}, status=400)
+
+    items, errors = [], []
+    for i, raw in enumerate(raw_orders):
+        item, err = _validate_bulk_item(raw)
+        if err:
+            errors.append({"index": i, "error": err})
+        else:
+            items.append(item)
+    if errors:
+        # 하나라도 틀리면 전체 거절 (부분 생성 없음)
+        return web.json_response({"error": "validation failed", "details": errors}, status=400)
+
+    # 배치 전체를 결제 1건으로: 항목 금액 합계 + 입금 구분용 오프셋
+    unique_offset = Decimal(str(random.randint(1, 9))) / Decimal("1000")
+    amount = (sum(Decimal(it["amount"]) for it in items) + unique_offset).quantize(Decimal("0.001"), rounding=ROUND_HALF_UP)
+    batch_id = f"bulk:{datetime.utcnow():%Y%m%d%H%M%S}:{secrets.token_hex(3)}"
+    created_at = time.time()
+    pay_address = _assign_pay_address()
+
+    pending_orders[batch_id] = {
+        "qty": sum(it["total_qty"] for it in items),
+        "amount": amount,
+        "chat_id": chat_id,
+        "type": "bulk",
+        "items": items,
+        "reference": str(body.get("reference") or ""),
+        "pay_address": pay_address,
+        "created_at": created_at,
+    }
+    _save_state()   # 배치 전체를 한 번에 기록
+    _stats_order("created", pending_orders[batch_id])
+    log.info("[BULK] batch=%s items=%s amount=%s chat=%s", batch_id, len(items), amount, chat_id)
+
+    return web.json_response({
+        "batch_id": batch_id,
+        "pay_address": pay_address,
+        "currency": "USDT(TRC20)",
+        "amount": str(amount),
+        "expires_at": created_at + ORDER_TTL,
+        "items": [
+            {"index": i, "type": it["type"], "qty": it["total_qty"], "amount": it["amount"]}
+            for i, it in enumerate(items)
+        ],
+        "note": "반드시 위 정확한 금액(소수점 포함)으로 1회 송금해주세요.",
+    }, status=201)
+
+async def _start_bulk_api(app):
+    if not BULK_API_PORT:
+        return
+    if not BULK_API_TOKEN:
+        log.error("[BULK_API] BULK_API_TOKEN이 없어 대량 주문 API를 시작하지 않습니다.")
+        return
+    webapp = web.Application(client_max_size=1024 ** 2)
+    webapp.router.add_post("/orders/bulk", bulk_orders_api)
+    runner = web.AppRunner(webapp)
+    await runner.setup()
+    await web.TCPSite(runner, BULK_API_HOST, BULK_API_PORT).start()
+    app.bot_data["bulk_api_runner"] = runner
+    log.info("[BULK_API] listening on %s:%s", BULK_API_HOST, BULK_API_PORT)
 
 # ─────────────────────────────────────────────
 # 메인 실행부
 # ─────────────────────────────────────────────
 async def on_startup(app):
+    _load_state()
+    admin_digest.load()   # 아웃박스 소비자 시작 전에 미전송 알림 복원
+    _replay_outbox()
+    for name in OUTBOX_CONSUMERS:
+        app.create_task(_run_outbox_consumer(app, name))
+    app.create_task(lag_monitor.run())
+    _load_sessions()
+    _load_stats()
+    app.job_queue.run_repeating(_checkpoint_stats, interval=STATS_CHECKPOINT, first=STATS_CHECKPOINT)
+    app.job_queue.run_repeating(_gc_sessions, interval=60, first=60)
+    if ADMIN_DIGEST_WINDOW > 0:
+        app.job_queue.run_repeating(_flush_admin_digest, interval=ADMIN_DIGEST_WINDOW, first=ADMIN_DIGEST_WINDOW)
+    app.job_queue.run_repeating(_compact_archive, interval=86400, first=300)
     app.create_task(check_tron_payments(app))
+    await _start_bulk_api(app)
+
+async def on_shutdown(app):
+    _save_stats()
+    runner = app.bot_data.pop("bulk_api_runner", None)
+    if runner is not None:
+        await runner.cleanup()
 
 def main():
     TOKEN = os.getenv("BOT_TOKEN")
@@ -958,10 +2871,17 @@ def main():
         print("❌ BOT_TOKEN이 .env에 설정되지 않았습니다.")
         return
 
-    app = ApplicationBuilder().token(TOKEN).post_init(on_startup).build()
+    app = ApplicationBuilder().token(TOKEN).post_init(on_startup).post_shutdown(on_shutdown).build()
 
     # 핸들러 추가 (start, 메뉴, 입력)
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("digest", digest_cmd))
+    app.add_handler(CommandHandler("history", history_cmd))
+    # 샘플링 동안(최대 PROFILE_MAX_SECONDS) 다른 업데이트 처리를 막지 않도록 비차단 실행
+    app.add_handler(CommandHandler("profile", profile_cmd, block=False))
+    app.add_handler(CommandHandler("lag", lag_cmd))
+    app.add_handler(CommandHandler("stats", stats_cmd))
+    app.add_handler(CommandHandler("credits", credits_cmd))
     app.add_handler(CallbackQueryHandler(menu_handler))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_input_handler))
 
@@ -0,0 +1,120 @@
+# fake_tron_node.py — 녹화한 블록을 그대로 돌려주는 로컬 TRON 풀노드 대역
+# INGEST_MODE=node 블록 스캔을 실제 노드 없이 확인하기 위한 도구.
+#
+# 녹화:  python fake_tron_node.py record --node http://NODE:8090 --start 60000000 --end 60000050 blocks.json
+# 실행:  python fake_tron_node.py serve blocks.json --port 8090 [--step 5 --interval 3]
+#        → 봇 실행 시 INGEST_MODE=node TRON_NODE_URL=http://127.0.0.1:8090 NODE_START_BLOCK=<첫 녹화 블록>
+#          (--step 을 주면 head가 첫 블록 직전에서 시작하므로 NODE_START_BLOCK 없이도 전부 스캔됨)
+#
+# 녹화 파일 형식:
+#   {"blocks": [getblockbylimitnext 의 block 항목...],
+#    "tx_info": {"<블록 번호>": [gettransactioninfobyblocknum 결과...]}}
+
+import argparse
+import asyncio
+import json
+import time
+from pathlib import Path
+
+import aiohttp
+from aiohttp import web
+
+# ─────────────────────────────
+# 녹화
+# ─────────────────────────────
+async def record(node: str, start: int, end: int, out: Path, batch: int = 50):
+    node = node.rstrip("/")
+    blocks, tx_info = [], {}
+    async with aiohttp.ClientSession() as session:
+        for s in range(start, end + 1, batch):
+            e = min(end, s + batch - 1)
+            async with session.post(f"{node}/wallet/getblockbylimitnext", json={"startNum": s, "endNum": e + 1}) as resp:
+                blocks += (await resp.json(content_type=None)).get("block") or []
+            for n in range(s, e + 1):
+                async with session.post(f"{node}/wallet/gettransactioninfobyblocknum", json={"num": n}) as resp:
+                    tx_info[str(n)] = await resp.json(content_type=None)
+            print(f"recorded {s}~{e}")
+    blocks.sort(key=lambda b: b["block_header"]["raw_data"]["number"])
+    out.write_text(json.dumps({"blocks": blocks, "tx_info": tx_info}), encoding="utf-8")
+
+# ─────────────────────────────
+# 재생 서버
+# ─────────────────────────────
+class RecordedChain:
+    """녹화 블록을 step 개씩 interval 초마다 '생성'되는 것처럼 노출"""
+    def __init__(self, data: dict, confirmations: int, step: int, interval: float):
+        self.blocks = {b["block_header"]["raw_data"]["number"]: b for b in data.get("blocks") or []}
+        self.tx_info = {int(n): v for n, v in (data.get("tx_info") or {}).items()}
+        self.first = min(self.blocks) if self.blocks else 0
+        self.last = max(self.blocks) if self.blocks else 0
+        self.confirmations = confirmations
+        self.step = step
+        self.interval = interval
+        self.started = time.monotonic()
+
+    def visible(self) -> int:
+        """현재 노출 중인 마지막 녹화 블록 번호"""
+        if not self.step:
+            return self.last
+        produced = int((time.monotonic() - self.started) / self.interval) * self.step
+        return min(self.last, self.first - 1 + produced)
+
+    def head(self) -> dict:
+        # 봇이 확정 대기(NODE_CONFIRMATIONS) 후 녹화 블록을 처리하도록 head를 그만큼 앞에 둠
+        return {"block_header": {"raw_data": {"number": self.visible() + self.confirmations}}}
+
+def make_app(chain: RecordedChain) -> web.Application:
+    async def getnowblock(request):
+        return web.json_response(chain.head())
+
+    async def getblockbylimitnext(request):
+        body = await request.json()
+        start, end = int(body["startNum"]), int(body["endNum"])
+        top = chain.visible()
+        return web.json_response({"block": [chain.blocks[n] for n in range(start, end) if n <= top and n in chain.blocks]})
+
+    async def gettransactioninfobyblocknum(request):
+        num = int((await request.json())["num"])
+        if num > chain.visible():
+            return web.json_response([])
+        return web.json_response(chain.tx_info.get(num, []))
+
+    app = web.Application()
+    app.router.add_post("/wallet/getnowblock", getnowblock)
+    app.router.add_post("/wallet/getblockbylimitnext", getblockbylimitnext)
+    app.router.add_post("/wallet/gettransactioninfobyblocknum", gettransactioninfobyblocknum)
+    return app
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="녹화 블록 기반 TRON 풀노드 대역")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    rec = sub.add_parser("record", help="실제 노드에서 블록 범위 녹화")
+    rec.add_argument("out", type=Path)
+    rec.add_argument("--node", required=True)
+    rec.add_argument("--start", type=int, required=True)
+    rec.add_argument("--end", type=int, required=True)
+
+    srv = sub.add_parser("serve", help="녹화 파일을 HTTP API로 재생")
+    srv.add_argument("recording", type=Path)
+    srv.add_argument("--host", default="127.0.0.1")
+    srv.add_argument("--port", type=int, default=8090)
+    srv.add_argument("--confirmations", type=int, default=19, help="봇의 NODE_CONFIRMATIONS 와 맞출 것")
+    srv.add_argument("--step", type=int, default=0, help="interval마다 노출할 블록 수 (0이면 전부 즉시)")
+    srv.add_argument("--interval", type=float, default=3.0)
+    args = ap.parse_args(argv)
+
+    if args.cmd == "record":
+        asyncio.run(record(args.node, args.start, args.end, args.out))
+        return
+
+    chain = RecordedChain(
+        json.loads(args.recording.read_text(encoding="utf-8")), args.confirmations, args.step, args.interval,
+    )
+    print(f"serving blocks {chain.first}~{chain.last} on {args.host}:{args.port}")
+    if not args.step:
+        print(f"봇 실행 시 NODE_START_BLOCK={chain.first} 로 지정해야 녹화 블록부터 스캔합니다.")
+    web.run_app(make_app(chain), host=args.host, port=args.port, print=None)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+# replay.py — 입금 내역 오프라인 재매칭 / 정산 검증 도구
+# 내보낸 TRC20 입금 덤프를 실시간 봇과 같은 디코더(TransferDecoder)·매칭(_match_transfer)으로 다시 돌려
+# 보관소(archive.db)에 기록된 결과와 비교한다.
+#
+# 사용 예:
+#   python replay.py dump.json
+#   python replay.py dumps/*.jsonl --since 2026-09-01 --until 2026-09-30 --workers 8 --json report.json
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from decimal import Decimal
+from pathlib import Path
+
+import bot
+
+# 주문/원장 상태가 이어지지 않는 공백(초). 이 이상 비면 구간을 나눠 병렬 처리
+SEGMENT_GAP = max(bot.ORDER_TTL, bot.LEDGER_WINDOW)
+
+# ─────────────────────────────
+# 덤프 읽기
+# ─────────────────────────────
+def _load_dump(path: Path) -> list[dict]:
+    text = path.read_text(encoding="utf-8")
+    if path.suffix == ".jsonl":
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    data = json.loads(text)
+    if isinstance(data, list):
+        return data
+    # fetch_txs 와 같은 응답 구조 (TronGrid / TronScan)
+    for key in ("data", "token_transfers", "trc20_transfers"):
+        if key in data:
+            return data[key]
+    return []
+
+def _decoder_class(row: dict):
+    """덤프 1행이 어느 조회 소스의 응답인지 판별"""
+    if "event_name" in row:
+        return bot.TronGridEventsDecoder
+    if "to_address" in row or "quant" in row:
+        return bot.TronScanDecoder
+    return bot.TronGridDecoder
+
+def _parse_chunk(rows: list[dict]) -> list[tuple]:
+    # 스트림(수신 주소 × 토큰)마다 실시간 루프와 같은 디코더로 파싱, 어느 스트림과도 무관한 행은 버림
+    decoders = {
+        cls: [cls(st) for st in bot.PAYMENT_STREAMS]
+        for cls in (bot.TronGridDecoder, bot.TronGridEventsDecoder, bot.TronScanDecoder)
+    }
+    out = []
+    for tx in rows:
+        for dec in decoders[_decoder_class(tx)]:
+            t = dec.parse(tx)
+            if t is not None:
+                out.append((bot._ts_seconds(t.ts), t.txid, t.from_addr, str(t.amount), t.to_addr))
+                break
+    return out
+
+# ─────────────────────────────
+# 기록된 주문 읽기
+# ─────────────────────────────
+def _order_key(row: dict) -> str:
+    return f"{row['uid']}@{row['created_at']:.3f}"
+
+def _load_recorded(archive: bot.OrderArchive, t0, t1):
+    """보관소의 paid/expired/unmatched 기록 → (주문 목록, 기록된 매칭, 기록된 미매칭 TXID)"""
+    rows = archive.query(None, t0=t0, t1=t1, limit=10 ** 9)
+    orders: dict[str, dict] = {}
+    tx_orders: dict[str, set] = {}
+    order_events: dict[str, set] = {}
+    unmatched: set[str] = set()
+
+    for r in rows:
+        if r["kind"] == "unmatched":
+            unmatched.add(r["txid"])
+            continue
+        if r["uid"] is None or r["created_at"] is None:
+            continue
+        key = _order_key(r)
+        order = orders.setdefault(key, {
+            "key": key,
+            "uid": r["uid"],
+            "amount": Decimal(r["amount"]),
+            "created_at": float(r["created_at"]),
+        })
+        pay_address = json.loads(r["detail"] or "{}").get("pay_address")
+        if pay_address:
+            order["pay_address"] = pay_address
+        if r["kind"] == "paid" and r["txid"]:
+            tx_orders.setdefault(r["txid"], set()).add(key)
+            order_events.setdefault(key, set()).add(r["ts"])
+    return orders, tx_orders, order_events, unmatched
+
+# ─────────────────────────────
+# 재매칭
+# ─────────────────────────────
+def _segments(transfers: list[tuple], orders: list[dict]) -> list[tuple]:
+    """SEGMENT_GAP 이상 이벤트가 없는 지점에서 잘라 서로 독립인 구간 목록 생성"""
+    events = sorted(
+        [(t[0], 1, i) for i, t in enumerate(transfers)] + [(o["created_at"], 0, i) for i, o in enumerate(orders)]
+    )
+    segments, cur_t, cur_o, last = [], [], [], None
+    for ts, is_tx, i in events:
+        if last is not None and ts - last > SEGMENT_GAP and (cur_t or cur_o):
+            segments.append((cur_t, cur_o))
+            cur_t, cur_o = [], []
+        (cur_t if is_tx else cur_o).append(transfers[i] if is_tx else orders[i])
+        last = ts
+    if cur_t or cur_o:
+        segments.append((cur_t, cur_o))
+    return segments
+
+def _replay_segment(segment: tuple) -> tuple[list, list]:
+    transfers, orders = segment
+    pending: dict[str, dict] = {}
+    ledger = bot.SenderLedger(bot.LEDGER_WINDOW)
+    matches, unmatched = [], []
+    oi = 0
+
+    for ts, txid, from_addr, amount, to_addr in transfers:
+        while oi < len(orders) and orders[oi]["created_at"] <= ts:
+            pending[orders[oi]["key"]] = orders[oi]
+            oi += 1
+        for key in [k for k, o in pending.items() if ts - o["created_at"] > bot.ORDER_TTL]:
+            del pending[key]
+
+        match = bot._match_transfer(pending, ledger, txid, from_addr, Decimal(amount), ts, to_addr)
+        if match:
+            key, _, txids, paid, _ = match
+            pending.pop(key)
+            matches.append((key, txids, str(paid)))
+        else:
+            unmatched.append(txid)
+    return matches, unmatched
+
+def _chunks(items: list, n: int) -> list[list]:
+    size = max(1, -(-len(items) // n))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+def replay(rows: list[dict], orders: list[dict], workers: int):
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        parsed = [t for chunk in pool.map(_parse_chunk, _chunks(rows, workers * 4)) for t in chunk]
+
+        # 같은 TXID는 한 번만 (실시간 루프의 processed_txs 와 동일)
+        transfers, seen = [], set()
+        for t in sorted(parsed):
+            if t[1] not in seen:
+                seen.add(t[1])
+                transfers.append(t)
+
+        orders = sorted(orders, key=lambda o: (o["created_at"], o["key"]))
+        segments = _segments(transfers, orders)
+        results = list(pool.map(_replay_segment, segments, chunksize=max(1, len(segments) // (workers * 4))))
+
+    matches = [m for seg, _ in results for m in seg]
+    unmatched = [u for _, seg in results for u in seg]
+    return transfers, matches, unmatched
+
+# ─────────────────────────────
+# 비교 리포트
+# ─────────────────────────────
+def compare(orders: dict, tx_orders: dict, order_events: dict, matches: list) -> dict:
+    replay_tx = {txid: key for key, txids, _ in matches for txid in txids}
+    recorded_paid = set(order_events)
+
+    missed = [
+        {"order": key, "txids": txids, "paid": paid, "recorded": "expired"}
+        for key, txids, paid in matches if key not in recorded_paid
+    ]
+    double_matched = (
+        [{"txid": txid, "orders": sorted(keys)} for txid, keys in sorted(tx_orders.items()) if len(keys) > 1]
+        + [{"order": key, "events": len(ev)} for key, ev in sorted(order_events.items()) if len(ev) > 1]
+    )
+    misattributed = [
+        {"txid": txid, "recorded": sorted(keys), "replay": replay_tx[txid]}
+        for txid, keys in sorted(tx_orders.items())
+        if txid in replay_tx and replay_tx[txid] not in keys
+    ]
+    unconfirmed = [
+        {"txid": txid, "recorded": sorted(keys)}
+        for txid, keys in sorted(tx_orders.items()) if txid not in replay_tx
+    ]
+    return {
+        "orders": len(orders),
+        "replay_matches": len(matches),
+        "missed": missed,
+        "double_matched": double_matched,
+        "misattributed": misattributed,
+        "unconfirmed": unconfirmed,
+    }
+
+def _print_report(report: dict, transfers: int, unmatched: int):
+    print(f"입금 {transfers}건 / 기록된 주문 {report['orders']}건 / 재매칭 {report['replay_matches']}건 / 미매칭 {unmatched}건")
+    sections = [
+        ("missed", "놓친 결제 (재매칭 O, 기록은 미결제)"),
+        ("double_matched", "중복 매칭"),
+        ("misattributed", "다른 주문에 매칭됨"),
+        ("unconfirmed", "기록은 결제, 재매칭 X"),
+    ]
+    for key, title in sections:
+        items = report[key]
+        print(f"\n■ {title}: {len(items)}건")
+        for item in items:
+            print("  - " + json.dumps(item, ensure_ascii=False))
+
+def _utc_date(s: str) -> float:
+    return datetime.strptime(s, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp()
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="TRC20 입금 덤프 재매칭 / 정산 검증")
+    ap.add_argument("dumps", nargs="+", type=Path, help="입금 덤프 (.json 응답 또는 .jsonl)")
+    ap.add_argument("--archive", type=Path, default=bot.ARCHIVE_FILE, help="비교할 보관소 (기본 archive.db)")
+    ap.add_argument("--since", help="시작일 YYYY-MM-DD (UTC)")
+    ap.add_argument("--until", help="종료일 YYYY-MM-DD (UTC, 포함)")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--json", type=Path, help="리포트를 JSON 파일로도 저장")
+    args = ap.parse_args(argv)
+
+    t0 = _utc_date(args.since) if args.since else None
+    t1 = _utc_date(args.until) + 86400 if args.until else None
+
+    rows = [tx for path in args.dumps for tx in _load_dump(path)]
+    # 경계에 걸친 주문도 포함되도록 결제 제한시간만큼 여유
+    orders, tx_orders, order_events, _ = _load_recorded(
+        bot.OrderArchive(args.archive),
+        t0 - bot.ORDER_TTL if t0 is not None else None,
+        t1 + bot.ORDER_TTL if t1 is not None else None,
+    )
+
+    transfers, matches, unmatched = replay(rows, list(orders.values()), max(1, args.workers))
+    if t0 is not None or t1 is not None:
+        in_range = {t[1] for t in transfers if (t0 is None or t[0] >= t0) and (t1 is None or t[0] < t1)}
+        matches = [m for m in matches if any(txid in in_range for txid in m[1])]
+        tx_orders = {txid: keys for txid, keys in tx_orders.items() if txid in in_range}
+
+    report = compare(orders, tx_orders, order_events, matches)
+    _print_report(report, len(transfers), len(unmatched))
+    if args.json:
+        args.json.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    problems = len(report["missed"]) + len(report["double_matched"]) + len(report["misattributed"])
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
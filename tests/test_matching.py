@@ -0,0 +1,83 @@
+# 입금 매칭(_match_transfer) 회귀 테스트: 단건 / 분할 합산 / 과다 입금 / 크레딧
+import os
+import time
+from decimal import Decimal
+
+import pytest
+
+pytest.importorskip("telegram")
+pytest.importorskip("aiohttp")
+os.environ.setdefault("BOT_TOKEN", "test")
+os.environ.setdefault("PAYMENT_ADDRESS", "TXYZopYRdj2D9XRtbG411XZZ3kM5VkAeBf")
+
+import bot  # noqa: E402
+
+SENDER = "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t"
+OTHER = "TLa2f6VPqDgRE67v1736s7bJ8Ray5wYjU7"
+
+def _orders(amount="18.004", created_at=None):
+    return {"u1": {"amount": Decimal(amount), "created_at": created_at or time.time()}}
+
+def _match(orders, ledger, txid, amount, ts_ms, sender=SENDER, credits=None):
+    return bot._match_transfer(orders, ledger, txid, sender, Decimal(amount), ts_ms, credits=credits)
+
+def test_exact_single_transfer():
+    orders = _orders()
+    match = _match(orders, bot.SenderLedger(900), "t1", "18.004", time.time() * 1000)
+    assert match[0] == "u1" and match[2] == ["t1"]
+
+def test_split_payment_from_same_sender():
+    orders, ledger = _orders(), bot.SenderLedger(900)
+    now_ms = time.time() * 1000
+    assert _match(orders, ledger, "t1", "10", now_ms) is None
+    match = _match(orders, ledger, "t2", "8.004", now_ms + 1000)
+    assert match[0] == "u1" and match[2] == ["t1", "t2"] and match[3] == Decimal("18.004")
+
+def test_split_ignores_transfers_before_order():
+    # 체인 타임스탬프(ms)와 주문 생성 시각(epoch 초)이 같은 기준이어야 함
+    created = time.time()
+    orders, ledger = _orders(created_at=created), bot.SenderLedger(900)
+    assert _match(orders, ledger, "t1", "10", (created - 60) * 1000) is None
+    assert _match(orders, ledger, "t2", "8.004", (created + 5) * 1000) is None
+
+def test_single_overpayment_above_cap_is_not_matched():
+    orders, ledger = _orders(), bot.SenderLedger(900)
+    assert _match(orders, ledger, "t1", "50", time.time() * 1000, sender=OTHER) is None
+
+def test_single_small_overpayment_leaves_credit():
+    orders, ledger = _orders(), bot.SenderLedger(900)
+    match = _match(orders, ledger, "t1", "20", time.time() * 1000)
+    assert match[0] == "u1" and match[2] == ["t1"] and match[3] - orders["u1"]["amount"] == Decimal("1.996")
+
+def test_split_overpayment_above_cap_is_not_matched():
+    orders, ledger = _orders(), bot.SenderLedger(900)
+    now_ms = time.time() * 1000
+    assert _match(orders, ledger, "t1", "10", now_ms) is None
+    assert _match(orders, ledger, "t2", "40", now_ms + 1000) is None
+
+def test_split_small_overpayment_leaves_credit():
+    orders, ledger = _orders(), bot.SenderLedger(900)
+    now_ms = time.time() * 1000
+    _match(orders, ledger, "t1", "10", now_ms)
+    match = _match(orders, ledger, "t2", "9", now_ms + 1000)
+    assert match[0] == "u1" and match[3] - orders["u1"]["amount"] == Decimal("0.996")
+
+def test_credit_covers_shortfall_of_next_order():
+    orders, ledger = _orders(), bot.SenderLedger(900)
+    credits = {SENDER: Decimal("3")}
+    match = _match(orders, ledger, "t1", "15.004", time.time() * 1000, credits=credits)
+    assert match[0] == "u1" and match[3] == Decimal("15.004") and match[4] == Decimal("3")
+
+def test_credit_of_other_sender_is_not_used():
+    orders, ledger = _orders(), bot.SenderLedger(900)
+    credits = {OTHER: Decimal("3")}
+    assert _match(orders, ledger, "t1", "15.004", time.time() * 1000, credits=credits) is None
+
+def test_ledger_since_handles_late_arrival():
+    ledger, now = bot.SenderLedger(900), time.time()
+    ledger.add(SENDER, now, Decimal("5"), "t1")
+    ledger.add(SENDER, now + 10, Decimal("7"), "t2")
+    ledger.add(SENDER, now + 5, Decimal("1"), "t3")
+    assert ledger.since(SENDER, now + 1) == (Decimal("8"), 2)
+    assert ledger.txids_since(SENDER, now + 1) == ["t3", "t2"]
+    assert ledger.total(SENDER) == Decimal("13")